@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# benchmark.py
+# Copyright 2026 Keith Maxwell
+# SPDX-License-Identifier: MPL-2.0
+"""Benchmark dotlocalslashbin against synthetic archives served locally.
+
+Fixtures in zip, tar.gz, tar.xz, gz, xz and bz2 formats are generated with a
+fixed seed and served by a local HTTP server. Each run times main end to end and
+reads the per-phase timings from the run report; a cold run starts with an empty
+cache and a warm run reuses the cache with a fresh output directory. Start up is
+timed with a separate process running --check against the warm cache. The
+medians are written as JSON and optionally compared against a baseline from an
+earlier run.
+"""
+
+import bz2
+import contextlib
+import gzip
+import json
+import lzma
+import os
+import tarfile
+from argparse import ArgumentParser, Namespace
+from collections.abc import Callable, Iterator
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from pathlib import Path
+from platform import python_version
+from random import Random
+from statistics import median
+from subprocess import DEVNULL, run
+from sys import executable
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import dotlocalslashbin
+from dotlocalslashbin import __version__, main
+
+FORMATS = ("zip", "tar.gz", "tar.xz", "gz", "xz", "bz2")
+SCENARIOS = ("cold", "warm")
+MIB = 1024 * 1024
+COMPRESS: dict[str, Callable[[bytes], bytes]] = {
+    "gz": gzip.compress,
+    "xz": lzma.compress,
+    "bz2": bz2.compress,
+}
+
+
+class _Handler(SimpleHTTPRequestHandler):
+    def log_message(self, *_: object) -> None:
+        """Do not log requests."""
+
+
+def _parse_args() -> Namespace:
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    help_ = "Total size of the members of each fixture in MiB (default: %(default)s)"
+    parser.add_argument("--size", default=8, help=help_, type=float)
+    help_ = "Number of members in each archive (default: %(default)s)"
+    parser.add_argument("--members", default=16, help=help_, type=int)
+    help_ = "Number of runs of each scenario (default: %(default)s)"
+    parser.add_argument("--repeat", default=3, help=help_, type=int)
+    help_ = "Write results to this file (default: %(default)s)"
+    parser.add_argument("--output", default="benchmark.json", help=help_, type=Path)
+    help_ = "Compare against results from an earlier run"
+    parser.add_argument("--baseline", help=help_, type=Path)
+    help_ = "Allowed ratio to the baseline before failing (default: %(default)s)"
+    parser.add_argument("--tolerance", default=1.25, help=help_, type=float)
+    return parser.parse_args()
+
+
+def _members(size: float, count: int) -> list[bytes]:
+    """Return reproducible data that is partly compressible."""
+    random = Random(0)  # noqa: S311 not used for cryptography
+    length = int(size * MIB) // count
+    return [
+        random.randbytes(length // 2) + bytes(length - length // 2)
+        for _ in range(count)
+    ]
+
+
+def _fixtures(directory: Path, members: list[bytes]) -> None:
+    """Write one fixture for each format to directory."""
+    with ZipFile(directory / "zip.zip", "w", ZIP_DEFLATED) as zip_:
+        for i, data in enumerate(members):
+            zip_.writestr(f"zip-{i}", data)
+    for format_ in ("tar.gz", "tar.xz"):
+        buffer = BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w") as tar:
+            for i, data in enumerate(members):
+                info = tarfile.TarInfo(f"{format_}-{i}")
+                info.size = len(data)
+                info.mode = 0o755
+                tar.addfile(info, BytesIO(data))
+        compress = COMPRESS[format_.removeprefix("tar.")]
+        directory.joinpath(f"{format_}.{format_}").write_bytes(
+            compress(buffer.getvalue()),
+        )
+    for format_, compress in COMPRESS.items():
+        directory.joinpath(f"{format_}.{format_}").write_bytes(
+            compress(b"".join(members)),
+        )
+
+
+@contextlib.contextmanager
+def _serve(directory: Path) -> Iterator[str]:
+    """Serve directory over HTTP yielding the base URL."""
+    handler = partial(_Handler, directory=str(directory))
+    with ThreadingHTTPServer(("127.0.0.1", 0), handler) as server:
+        thread = Thread(target=server.serve_forever, kwargs={"poll_interval": 0.01})
+        thread.start()
+        try:
+            yield f"http://127.0.0.1:{server.server_port}"
+        finally:
+            server.shutdown()
+            thread.join()
+
+
+def _run(toml: Path, cache: Path, directory: Path) -> tuple[float, dict]:
+    """Run main once returning the elapsed time and the report."""
+    with TemporaryDirectory(dir=directory) as output:
+        report = Path(output) / "report.json"
+        args = [f"--output={output}", f"--cache={cache}", f"--report={report}"]
+        start = perf_counter()
+        with contextlib.redirect_stdout(StringIO()):
+            main([*args, str(toml)])
+        elapsed = perf_counter() - start
+        return elapsed, json.loads(report.read_text())
+
+
+def _check(toml: Path, cache: Path, directory: Path) -> float:
+    """Time a new process checking the items, including start up."""
+    with TemporaryDirectory(dir=directory) as output:
+        code = "from dotlocalslashbin import main; raise SystemExit(main())"
+        args = [f"--output={output}", f"--cache={cache}", "--check", str(toml)]
+        env = os.environ | {"PYTHONPATH": str(Path(dotlocalslashbin.__file__).parent)}
+        start = perf_counter()
+        run([executable, "-c", code, *args], check=False, env=env, stdout=DEVNULL)
+        return perf_counter() - start
+
+
+def _benchmark(args: Namespace, directory: Path, url: str) -> dict[str, dict]:
+    """Return median timings by scenario and then by format or "main"."""
+    toml = directory / "input.toml"
+    toml.write_text("".join(f'["{i}"]\nurl = "{url}/{i}.{i}"\n' for i in FORMATS))
+    runs: dict[str, list[tuple[float, dict]]] = {i: [] for i in SCENARIOS}
+    checks = []
+    for _ in range(args.repeat):
+        with TemporaryDirectory(dir=directory) as cache:
+            runs["cold"].append(_run(toml, Path(cache), directory))
+            runs["warm"].append(_run(toml, Path(cache), directory))
+            checks.append(_check(toml, Path(cache), directory))
+
+    results: dict[str, dict] = {}
+    for scenario, values in runs.items():
+        results[scenario] = {"main": {"total": median(i for i, _ in values)}}
+        for name in FORMATS:
+            timings = [
+                next(i for i in report["items"] if i["name"] == name)["timings"]
+                for _, report in values
+            ]
+            phases = {key for i in timings for key in i}
+            results[scenario][name] = {
+                phase: median(i.get(phase, 0) for i in timings)
+                for phase in sorted(phases)
+            }
+    results["check"] = {"main": {"total": median(checks)}}
+    return results
+
+
+def _compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Return a message for each total slower than the baseline allows."""
+    messages = []
+    for scenario, names in results["results"].items():
+        for name, phases in names.items():
+            before = baseline["results"].get(scenario, {}).get(name, {}).get("total")
+            if before and phases["total"] > before * tolerance:
+                ratio = phases["total"] / before
+                messages.append(f"{scenario} {name}: {ratio:.2f} times slower")
+    return messages
+
+
+def benchmark() -> int:
+    """Generate fixtures, time each scenario and store the results."""
+    args = _parse_args()
+    with TemporaryDirectory(prefix="benchmark_") as name:
+        directory = Path(name)
+        fixtures = directory / "fixtures"
+        fixtures.mkdir()
+        _fixtures(fixtures, _members(args.size, args.members))
+        with _serve(fixtures) as url:
+            results = {
+                "version": __version__,
+                "python": python_version(),
+                "size": args.size,
+                "members": args.members,
+                "repeat": args.repeat,
+                "results": _benchmark(args, directory, url),
+            }
+    args.output.write_text(json.dumps(results, indent=2) + "\n")
+
+    for scenario, names in results["results"].items():
+        for name, phases in names.items():
+            summary = " ".join(f"{k}={v:.3f}s" for k, v in phases.items())
+            print(f"{scenario} {name}: {summary}")
+
+    if args.baseline is None:
+        return 0
+    messages = _compare(results, json.loads(args.baseline.read_text()), args.tolerance)
+    for message in messages:
+        print(f"Regression: {message}")
+    return 1 if messages else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(benchmark())
@@ -79,6 +79,12 @@ def test(session: Session) -> None:
         session.skip("No test files in repository")
 
 
+@nox.session(venv_backend="none", requires=["dev"], default=False)
+def benchmark(session: Session) -> None:
+    """Run the benchmarks, passing any arguments through, only on request."""
+    session.run(PYTHON, "benchmark.py", *session.posargs, external=True)
+
+
 if __name__ == "__main__":
     nox.main()
 
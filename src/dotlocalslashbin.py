@@ -8,37 +8,104 @@
 # ///
 """Download and extract files to `~/.local/bin/`."""
 
-from argparse import ArgumentParser, BooleanOptionalAction, Namespace
-from dataclasses import dataclass
+from __future__ import annotations
+
+import sys
+from argparse import ArgumentParser, ArgumentTypeError, BooleanOptionalAction, Namespace
+from contextlib import contextmanager, ExitStack, suppress
+from dataclasses import dataclass, field, replace
 from enum import Enum
-from gzip import GzipFile
-from hashlib import file_digest
+from fcntl import flock, ioctl, LOCK_EX, LOCK_NB, LOCK_SH
+from fnmatch import fnmatchcase
+from functools import partial
+from http import HTTPStatus
+from io import (
+    BufferedIOBase,
+    BufferedReader,
+    BytesIO,
+    RawIOBase,
+    SEEK_CUR,
+    SEEK_END,
+    SEEK_SET,
+)
+from json import dumps, loads
+from os import getpid
 from pathlib import Path
-from shlex import split
-from shutil import copy, copyfileobj
 from stat import S_IEXEC
-from subprocess import run
-from tarfile import open as tar_open, TarFile, TarInfo
+from threading import get_ident, Lock
+from time import perf_counter, sleep, time
 from tomllib import load
-from urllib.error import HTTPError
-from urllib.request import urlopen
-from zipfile import ZipFile, ZipInfo
+from typing import BinaryIO, TYPE_CHECKING
+
+# other modules are imported where they are used, so that starting is fast
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable, Iterator, Mapping
+    from concurrent.futures import Executor, Future
+    from contextlib import AbstractContextManager
+    from http.client import HTTPConnection, HTTPResponse
+    from urllib.parse import SplitResult
+
+    from _typeshed import WriteableBuffer
 
 __version__ = "0.0.27"
 
 _CACHE = Path("~/.cache/dotlocalslashbin/")
 _HOME = str(Path("~").expanduser())
+_REMOTE = ("https://", "http://")
 _OUTPUT = Path("~/.local/bin/")
 _SHA512_LENGTH = 128
+_CHUNK_SIZE = 1024 * 1024
+_MANIFEST = "manifest.json"
+_INDEX = "index.json"
+_ACCESS = "access.json"
+_DIGESTS = "digests.json"
+_LOCKS = "locks"  # never removed by --clear so that locks stay effective
+_DAY = 24 * 60 * 60
+_FILE = "file"  # name for the result of decompressing a single file
+_FICLONE = 0x40049409  # from linux/fs.h
+_REDIRECTS = (301, 302, 303, 307, 308)
+_MAX_REDIRECTS = 10
+_MAX_DELAY = 120
+_UNITS = {"": 1, "K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
 
 
 class _CustomNamespace(Namespace):
     output: Path
     input: list[Path]
     cache: Path
+    jobs: int
+    gc: bool
+    cache_max_size: int | None
+    cache_max_age: int | None
+    reverify: bool
+    link_mode: str
+    remote_zip: bool
+    retries: int
+    retry_delay: float
+    report: Path | None
+    profile: bool
+    download_only: bool
+    no_cache: bool
+    export_bundle: Path | None
+    import_bundle: Path | None
+    check: bool
+    only: list[str] | None
+    exclude: list[str] | None
 
 
-Action = Enum("Action", ["command", "copy", "gunzip", "symlink", "untar", "unzip"])
+Action = Enum(
+    "Action",
+    ["bunzip2", "command", "copy", "gunzip", "symlink", "untar", "unxz", "unzip"],
+)
+_SINGLE = (Action.bunzip2, Action.gunzip, Action.unxz)  # decompress to one file
+_CPU_BOUND = (*_SINGLE, Action.untar, Action.unzip)
+_STREAMED = (*_SINGLE, Action.copy, Action.untar)
+_MAGIC = {
+    b"\x1f\x8b": Action.gunzip,
+    b"\xfd7zXZ\x00": Action.unxz,
+    b"BZh": Action.bunzip2,
+}
+LinkMode = Enum("LinkMode", ["auto", "copy", "hardlink", "reflink"])
 
 
 @dataclass(init=False)
@@ -55,56 +122,773 @@ class Item:
     prefix: str
     command: str | None
     ignore: set
+    tags: set
+    tree: Path | None
+    retries: int | None
+    retry_delay: float | None
+    sniff: bool
+
+
+@dataclass
+class _State:
+    """What happened to an item during a run, returned in its result."""
+
+    status: str = "pending"
+    transferred: int = 0
+    size: int | None = None
+    error: str | None = None
+    version_output: str = ""
+    outputs: tuple[Path, ...] = ()
+    timings: dict[str, float] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class _Context:
+    """Options for a run that apply to every item, with the state of each item.
+
+    States are kept by name, which is unique within the input.
+    """
+
+    link: LinkMode = LinkMode.copy
+    remote_zip: bool = False
+    stream: bool = False
+    quiet: bool = False
+    retries: int = 3
+    retry_delay: float = 1.0
+    states: dict[str, _State] = field(default_factory=dict)
+
+    def state(self, item: Item) -> _State:
+        return self.states.setdefault(item.name, _State())
+
+
+@dataclass(frozen=True)
+class Result:
+    """The outcome of processing an item, returned by install.
+
+    The status is one of current, cached, local, downloaded, remote, streamed or
+    failed; outputs are the files and directories installed for the item.
+    """
+
+    name: str
+    url: str
+    status: str
+    target: Path
+    outputs: tuple[Path, ...]
+    downloaded: Path
+    bytes_transferred: int
+    size: int | None
+    timings: dict[str, float]
+    error: str | None
+    version_output: str
+
+
+class _Manifest:
+    """Inputs and outputs of items installed by previous runs.
+
+    An item is current if its inputs are unchanged and every file it produced
+    still has the same size, modification time and inode. Each file belongs to
+    the item that wrote it last, so items that install the same file, like a
+    LICENSE from two archives, do not make each other stale.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.entries: dict[str, dict] = _load_json(path)
+        self.removed: set[str] = set()
+        self.lock = Lock()
+
+    def current(self, item: Item) -> bool:
+        with self.lock:
+            entry = self.entries.get(str(item.target))
+            if entry is None or entry["inputs"] != _inputs(item):
+                return False
+            outputs: dict[str, list | None] = entry["outputs"]
+            return all(_fingerprint(Path(i)) == j for i, j in outputs.items())
+
+    def record(self, item: Item, outputs: list[Path]) -> None:
+        fingerprints = {str(i): _fingerprint(i) for i in outputs}
+        with self.lock:
+            for target, entry in self.entries.items():
+                if target == str(item.target):
+                    continue
+                previous = entry["outputs"]
+                if previous.keys() & fingerprints.keys():
+                    owned = {k: v for k, v in previous.items() if k not in fingerprints}
+                    self.entries[target] = entry | {"outputs": owned}
+            self.entries[str(item.target)] = {
+                "inputs": _inputs(item),
+                "outputs": fingerprints,
+            }
+
+    def outputs(self, item: Item) -> tuple[Path, ...]:
+        with self.lock:
+            entry = self.entries.get(str(item.target), {})
+            return tuple(map(Path, entry.get("outputs", {})))
+
+    def forget(self, item: Item) -> None:
+        with self.lock:
+            self.entries.pop(str(item.target), None)
+            self.removed.add(str(item.target))
+
+    def version(self, item: Item) -> str | None:
+        """Return the saved output of the version check, if it is still valid.
+
+        The output is valid while the arguments and the size, modification time
+        and inode of the target are unchanged.
+        """
+        with self.lock:
+            saved = self.entries.get(str(item.target), {}).get("version", {})
+        return saved["output"] if saved.get("key") == _version_key(item) else None
+
+    def record_version(self, item: Item, output: str) -> None:
+        """Save the output of the version check with the other details of item.
+
+        Only items that are installed or current have an entry; the output is
+        not saved for any other item, so the check runs again next time.
+        """
+        with self.lock:
+            if (entry := self.entries.get(str(item.target))) is not None:
+                version = {"key": _version_key(item), "output": output}
+                self.entries[str(item.target)] = entry | {"version": version}
+
+    def save(self) -> None:
+        _update_json(self.path, self.entries, self.removed)
+
+
+class _Cache:
+    """Downloads stored by SHA256 with an index from URL to digest.
+
+    Files cached by earlier versions under the last part of the URL are still
+    used if there is no entry in the index. The time each download was last
+    used is recorded so that the least recently used can be evicted first.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+        self.index: dict[str, str] = _load_json(directory / _INDEX)
+        self.access: dict[str, float] = _load_json(directory / _ACCESS)
+        self.evicted: set[str] = set()  # digests and trees
+        self.forgotten: set[str] = set()  # URLs
+
+    def blob(self, digest: str) -> Path:
+        return self.directory / "sha256" / digest
+
+    def named(self, path: Path) -> str | None:
+        """Return the SHA256 of a download from its name, if it is in the cache."""
+        return path.name if path == self.blob(path.name) else None
+
+    def digest(self, item: Item) -> str | None:
+        if item.url in self.index:
+            return self.index[item.url]
+        if item.expected and _algorithm(item.expected) == "sha256":
+            return item.expected
+        return None
+
+    def lookup(self, item: Item) -> Path | None:
+        if item.url not in self.index:  # another process may have downloaded it
+            for url, digest in _load_json(self.directory / _INDEX).items():
+                self.index.setdefault(url, digest)
+        digest = self.digest(item)
+        if digest is None or not (path := self.blob(digest)).is_file():
+            return None
+        self.index[item.url] = digest
+        self.access[digest] = time()
+        return path
+
+    def add(self, url: str, temporary: Path, digest: str) -> Path:
+        path = self.store(temporary, digest)
+        self.index[url] = digest
+        self.access[digest] = time()
+        self.save()  # so that other processes waiting for the download use it
+        return path
+
+    def store(self, temporary: Path, digest: str) -> Path:
+        """Move a file with a known digest into the cache."""
+        path = self.blob(digest)
+        if not path.is_file():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temporary.replace(path)
+        return path
+
+    def lock(self, url: str) -> AbstractContextManager[int]:
+        """Return a lock for url shared between threads and processes."""
+        name = f"{_sha256(url.encode())}.lock"
+        return _locked(self.directory / _LOCKS / name)
+
+    def prune_locks(self) -> None:
+        """Remove the locks for URLs that are no longer in the index.
+
+        Only safe while holding the exclusive lock on the whole cache.
+        """
+        from re import fullmatch
+
+        keep = {f"{_sha256(url.encode())}.lock" for url in self.index}
+        for path in (self.directory / _LOCKS).glob("*.lock"):
+            if fullmatch(r"[0-9a-f]{64}\.lock", path.name) and path.name not in keep:
+                path.unlink()
+
+    def partial(self, url: str) -> Path:
+        """Return the path for an incomplete download of url."""
+        return self.directory / "partial" / f"{_sha256(url.encode())}.part"
+
+    def tree(self, item: Item, digest: str) -> Path:
+        """Return the directory for the unpacked contents of an archive.
+
+        The same archive, prefix and ignored files always unpack to the same
+        files, so the tree is reused by every item and run that needs them.
+        """
+        key = dumps([digest, item.action.name, item.prefix, sorted(item.ignore)])
+        return self.directory / "trees" / _sha256(key.encode())
+
+    def used(self, path: Path) -> None:
+        """Record that a download or tree in the cache was used now."""
+        self.access[path.name] = time()
+
+    def keep(self, items: list[Item]) -> set[str]:
+        """Return the names of the downloads and trees used by items."""
+        names = set()
+        for item in items:
+            if (digest := self.digest(item)) is not None:
+                names.add(digest)
+                if item.action in _CPU_BOUND:
+                    names.add(self.tree(item, digest).name)
+        return names
+
+    def evict(
+        self,
+        keep: set[str],
+        max_size: int | None,
+        max_age: int | None,
+    ) -> list[Path]:
+        """Remove the least recently used downloads and trees until within limits.
+
+        Downloads and trees with a name in keep are never removed. The size of a
+        tree is the total size of the files in it.
+        """
+        if max_size is None and max_age is None:
+            return []
+
+        entries = []
+        for directory in (self.directory / "sha256", self.directory / "trees"):
+            for path in directory.iterdir() if directory.is_dir() else ():
+                stat = path.stat()
+                size = stat.st_size
+                if path.is_dir():
+                    size = sum(i.lstat().st_size for i in path.rglob("*"))
+                accessed = self.access.get(path.name, stat.st_mtime)
+                entries.append((accessed, size, path))
+        entries.sort()
+
+        now = time()
+        total = sum(size for _, size, _ in entries)
+        removed = []
+        for accessed, size, path in entries:
+            too_old = max_age is not None and now - accessed > max_age * _DAY
+            too_big = max_size is not None and total > max_size
+            if path.name in keep or not (too_old or too_big):
+                continue
+            if path.is_dir():
+                from shutil import rmtree
+
+                rmtree(path)
+            else:
+                path.unlink()
+            total -= size
+            self.access.pop(path.name, None)
+            self.evicted.add(path.name)
+            self.forgotten |= {k for k, v in self.index.items() if v == path.name}
+            self.index = {k: v for k, v in self.index.items() if v != path.name}
+            removed.append(path)
+        return removed
+
+    def save(self) -> None:
+        _update_json(self.directory / _INDEX, self.index, self.forgotten)
+        _update_json(self.directory / _ACCESS, self.access, self.evicted)
+
+
+class _Digests:
+    """Digests of files that have already been calculated.
+
+    Keyed by device, inode, size, modification time and algorithm, so that an
+    unchanged file is not hashed again. The path is kept with each digest so
+    that entries for files that were removed or changed can be dropped.
+    """
+
+    def __init__(self, path: Path, *, reverify: bool = False) -> None:
+        self.path = path
+        self.reverify = reverify
+        self.entries: dict[str, dict[str, str]] = _load_json(path)
+
+    @staticmethod
+    def key(path: Path, algorithm: str) -> str:
+        stat = path.stat()
+        return (
+            f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}:{algorithm}"
+        )
+
+    def get(self, path: Path, algorithm: str) -> str | None:
+        if self.reverify:
+            return None
+        entry = self.entries.get(self.key(path, algorithm))
+        return entry["digest"] if isinstance(entry, dict) else None
+
+    def record(self, path: Path, algorithm: str, digest: str) -> None:
+        entry = {"digest": digest, "path": str(path.absolute())}
+        self.entries[self.key(path, algorithm)] = entry
+
+    def stale(self, key: str) -> bool:
+        """Return True if the file for an entry no longer has the same key."""
+        entry = self.entries[key]
+        if not isinstance(entry, dict) or "path" not in entry:
+            return True  # saved by an earlier version
+        try:
+            return self.key(Path(entry["path"]), key.rsplit(":", 1)[-1]) != key
+        except OSError:
+            return True
+
+    def save(self) -> None:
+        stale = {i for i in self.entries if self.stale(i)}
+        for key in stale:
+            del self.entries[key]
+        _update_json(self.path, self.entries, stale)
+
+
+class _Connections:
+    """Persistent HTTP connections, kept open for reuse per scheme and host.
+
+    Redirects are followed with connections from the same pool. Other schemes
+    and requests through a proxy are passed to urlopen.
+    """
+
+    def __init__(self) -> None:
+        self.idle: dict[tuple[str, str], list[HTTPConnection]] = {}
+        self.lock = Lock()
+
+    @contextmanager
+    def open(
+        self,
+        url: str,
+        headers: dict[str, str] | None = None,
+    ) -> Iterator[HTTPResponse]:
+        """Send a GET request for url and yield the response."""
+        from urllib.error import HTTPError
+        from urllib.parse import urljoin, urlsplit
+        from urllib.request import getproxies, Request, urlopen
+
+        headers = {"User-Agent": f"dotlocalslashbin/{__version__}"} | (headers or {})
+        for _ in range(_MAX_REDIRECTS + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ("http", "https") or parts.scheme in getproxies():
+                with urlopen(Request(url, headers=headers)) as response:
+                    yield response
+                return
+
+            connection, response = self._request(parts, headers)
+            if response.status >= HTTPStatus.BAD_REQUEST or (
+                response.status in _REDIRECTS and response.getheader("Location")
+            ):
+                response.read()
+                self._release(parts, connection, response)
+                if response.status >= HTTPStatus.BAD_REQUEST:
+                    reason, info = response.reason, response.headers
+                    raise HTTPError(url, response.status, reason, info, None)
+                url = urljoin(url, response.getheader("Location"))
+                continue
+
+            try:
+                yield response
+            finally:
+                self._release(parts, connection, response)
+            return
+
+        msg = f"Too many redirects for {url}"
+        raise RuntimeError(msg)
+
+    def _request(
+        self,
+        parts: SplitResult,
+        headers: dict[str, str],
+    ) -> tuple[HTTPConnection, HTTPResponse]:
+        from http.client import HTTPConnection, HTTPException, HTTPSConnection
+
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        with self.lock:
+            idle = self.idle.get((parts.scheme, parts.netloc), [])
+            connection = idle.pop() if idle else None
+        if connection is not None:
+            try:
+                connection.request("GET", path, headers=headers)
+                return connection, connection.getresponse()
+            except (OSError, HTTPException):  # the server closed an idle connection
+                connection.close()
+        if parts.scheme == "https":
+            connection = HTTPSConnection(parts.netloc)
+        else:
+            connection = HTTPConnection(parts.netloc)
+        connection.request("GET", path, headers=headers)
+        return connection, connection.getresponse()
+
+    def _release(
+        self,
+        parts: SplitResult,
+        connection: HTTPConnection,
+        response: HTTPResponse,
+    ) -> None:
+        """Keep a connection for reuse if the whole response was read."""
+        if response.isclosed() and not response.will_close:
+            key = (parts.scheme, parts.netloc)
+            with self.lock:
+                self.idle.setdefault(key, []).append(connection)
+        else:
+            connection.close()
+
+
+_CONNECTIONS = _Connections()
 
 
 def main(_args: list[str] | None = None) -> int:
     """Parse command line arguments and download each file."""
     args = _parse_args(_args)
+    if args.check:
+        return _check(args)
+    with _session(args) as lock:
+        return _run(args, lock, _items(args), _context(args))
+
+
+def install(
+    specs: Mapping[str, Mapping],
+    args: list[str] | None = None,
+) -> list[Result]:
+    """Install items without printing, returning a result for each.
+
+    Each spec has the same keys as a table in the TOML input, keyed by name. The
+    args are command line options, for example ["--output=~/bin", "--jobs=4"].
+    Errors installing an item are recorded in its result instead of being
+    raised. Invalid specs and args still raise, for example KeyError for a spec
+    without a url or SystemExit from parsing args.
+    """
+    options = _parser().parse_args(args or [], namespace=_CustomNamespace())
+    items = [_item(name, dict(record), options) for name, record in specs.items()]
+    context = _context(options, quiet=True)
+    with _session(options) as lock:
+        _run(options, lock, items, context)
+    return [_result(i, context.state(i)) for i in items if _selected(i, options)]
+
+
+async def install_async(
+    specs: Mapping[str, Mapping],
+    args: list[str] | None = None,
+) -> list[Result]:
+    """Install items like install without blocking the event loop.
+
+    Concurrent calls share the cache, using the same locks as separate runs, and
+    the persistent HTTP connections.
+    """
+    from asyncio import to_thread
+
+    return await to_thread(install, specs, args)
+
+
+@contextmanager
+def _session(args: _CustomNamespace) -> Iterator[int]:
+    """Lock the cache for a run, clearing it first if requested.
+
+    The whole run holds a shared lock on the cache directory, other runs can
+    use the cache at the same time but not clear it or collect garbage.
+    """
+    operation = LOCK_EX if args.clear or args.gc else LOCK_SH
+    with ExitStack() as stack:
+        if args.no_cache:  # still needed for the manifest and some actions
+            from tempfile import TemporaryDirectory
+
+            directory = stack.enter_context(TemporaryDirectory(prefix="cache_"))
+            args.cache = Path(directory)
+        lockfile = args.cache.expanduser() / _LOCKS / "cache"
+        lock = stack.enter_context(_locked(lockfile, operation))
+        if args.clear:
+            from shutil import rmtree
+
+            for path in args.cache.expanduser().iterdir():
+                if path.name == _LOCKS:
+                    continue
+                if path.is_dir() and not path.is_symlink():
+                    rmtree(path)
+                else:
+                    path.unlink()
+            flock(lock, LOCK_SH)
+        yield lock
+
+
+def _run(
+    args: _CustomNamespace,
+    lock: int,
+    items: list[Item],
+    context: _Context,
+) -> int:
+    """Process the selected items, holding a lock on the cache.
+
+    Downloads for items that are not selected are still kept when evicting. If
+    the context is quiet nothing is printed and every item is processed even
+    after errors.
+    """
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+    echo = _ignore if context.quiet else print
+    manifest = _Manifest(args.cache.expanduser() / _MANIFEST)
+    cache = _Cache(args.cache.expanduser())
+    digests = _Digests(args.cache.expanduser() / _DIGESTS, reverify=args.reverify)
 
-    if args.clear:
-        for path in args.cache.expanduser().iterdir():
-            path.unlink()
+    if args.import_bundle:
+        count = _import_bundle(args.import_bundle.expanduser(), cache)
+        echo(f"Imported {count} files from {args.import_bundle}")
 
+    if args.gc:
+        keep = cache.keep(items)
+        removed = cache.evict(keep, args.cache_max_size, args.cache_max_age)
+        cache.prune_locks()
+        cache.save()
+        echo(f"Removed {len(removed)} files from {args.cache}")
+        return 0
+
+    everything, items = items, [i for i in items if _selected(i, args)]
+
+    start = perf_counter()
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    pool = None
+    if args.jobs > 1 and any(i.action in _CPU_BOUND for i in items):
+        from multiprocessing import get_context
+
+        # decompression is bound by CPU not I/O; a forked worker would inherit
+        # any lock held by another thread at that moment and never release it
+        pool = ProcessPoolExecutor(mp_context=get_context("forkserver"))
+    fetch_only = args.download_only or args.export_bundle is not None
+    try:
+        if fetch_only:
+            process = partial(_prefetch, context=context, cache=cache, digests=digests)
+        else:
+            process = partial(
+                _process,
+                context=context,
+                manifest=manifest,
+                cache=cache,
+                digests=digests,
+                pool=pool,
+            )
+        submitted = _submit(executor, items, process)
+        # with one job submit lazily so that output is interleaved as before
+        futures = submitted if args.jobs == 1 else list(submitted)
+        display: Callable[[Item], None] = partial(_display, context=context)
+        if fetch_only:
+            display = _display_download
+        if context.quiet:
+            _collect(items, futures, context)
+        elif not _wait(items, futures, display, context):
+            return 1
+
+        if args.export_bundle:
+            count = _export_bundle(args.export_bundle.expanduser(), items, cache)
+            echo(f"Exported {count} files to {args.export_bundle}")
+        _evict(args, everything, cache, lock)
+    finally:
+        executor.shutdown(cancel_futures=True)
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        manifest.save()
+        cache.save()
+        digests.save()
+        _summarize(args, items, context, perf_counter() - start)
+
+    return 0
+
+
+def _check(args: _CustomNamespace) -> int:
+    """Report which items are missing, stale or up to date.
+
+    Only stat is used: nothing is downloaded, hashed, extracted or run and the
+    cache is not locked or written. Returns 1 if any item needs installing.
+    """
+    items = [i for i in _items(args) if _selected(i, args)]
+    manifest = _Manifest(args.cache.expanduser() / _MANIFEST)
+    cache = _Cache(args.cache.expanduser())
+    result = 0
+    for item in items:
+        digest = cache.digest(item) if item.url.startswith(_REMOTE) else None
+        if digest is not None and (path := cache.blob(digest)).is_file():
+            item.downloaded = path
+        if _fingerprint(item.target) is None:
+            state = "missing"
+        elif manifest.current(item):
+            state = "up to date"
+        else:
+            state = "stale"
+        target = str(item.target).replace(_HOME, "~")
+        print(f"{state}: {item.name} {target}")
+        result = result or int(state != "up to date")
+    return result
+
+
+def _items(args: _CustomNamespace) -> list[Item]:
+    """Load the items from every input file, later files taking precedence."""
     data: dict[str, dict] = {}
     for i in args.input:
         with i.expanduser().open("rb") as file:
             data |= load(file)
+    return [_item(name, record, args) for name, record in data.items()]
 
-    for name, record in data.items():
-        item = Item()
-        item.name = name
-        item.url = record["url"]
-        default = args.output.joinpath(name)
-        item.target = Path(record.get("target", default)).expanduser()
-        item.ignore = record.get("ignore", set())
-        item.expected = record.get("expected", None)
-        item.version = record.get("version", "")
-        item.prefix = record.get("prefix", "")
-        if item.prefix and item.prefix[-1] != "/":
-            item.prefix += "/"
-        item.command = record.get("command", None)
-
-        if "action" in record:
-            item.action = getattr(Action, record["action"])
-        else:
-            item.action = _guess_action(item)
 
-        if item.url.startswith("https://"):
-            item.downloaded = args.cache.expanduser() / item.url.rsplit("/", 1)[1]
-        else:
-            item.downloaded = Path(item.url)
+def _selected(item: Item, args: _CustomNamespace) -> bool:
+    """Return True if item matches --only, if given, and does not match --exclude.
+
+    Each glob is matched against the name of the item and each of its tags.
+    """
+    names = [item.name, *item.tags]
+    if args.only and not any(fnmatchcase(i, j) for i in names for j in args.only):
+        return False
+    return not any(fnmatchcase(i, j) for i in names for j in args.exclude or ())
+
+
+def _submit(
+    executor: Executor,
+    items: list[Item],
+    process: Callable[[list[Item]], None],
+) -> Iterator[Future]:
+    """Yield a future for each item, submitting items with one archive together."""
+    groups: dict[str, list[Item]] = {}
+    for item in items:
+        groups.setdefault(_group(item), []).append(item)
+    futures: dict[str, Future] = {}
+    for item in items:
+        key = _group(item)
+        if key not in futures:
+            futures[key] = executor.submit(process, groups[key])
+        yield futures[key]
+
+
+def _group(item: Item) -> str:
+    """Return a key that is the same for items extracted from one archive."""
+    if item.action in (Action.untar, Action.unzip):
+        return f"{item.action.name} {item.url}"
+    return str(id(item))
+
+
+def _evict(args: _CustomNamespace, items: list[Item], cache: _Cache, lock: int) -> None:
+    """Evict downloads beyond the limits, unless another run is using the cache."""
+    if args.cache_max_size is None and args.cache_max_age is None:
+        return
+    try:
+        flock(lock, LOCK_EX | LOCK_NB)
+    except BlockingIOError:
+        return  # a later run can evict instead
+    cache.evict(cache.keep(items), args.cache_max_size, args.cache_max_age)
+
+
+def _wait(
+    items: list[Item],
+    futures: Iterable[Future],
+    display: Callable[[Item], None],
+    context: _Context,
+) -> bool:
+    """Display each item in order once processed, returning False on error."""
+    from urllib.error import HTTPError
+
+    for item, future in zip(items, futures, strict=True):
         try:
-            _process(item)
+            future.result()
         except HTTPError as e:
+            context.state(item).error = str(e)
             print(f"Error {e.code} downloading {e.url}")
-            return 1
+            return False
+        except Exception as e:
+            context.state(item).error = str(e)
+            raise
 
-        _display(item)
+        display(item)
+    return True
 
-    return 0
 
+def _collect(items: list[Item], futures: Iterable[Future], context: _Context) -> None:
+    """Wait for every item, recording errors instead of raising them."""
+    for item, future in zip(items, futures, strict=True):
+        try:
+            future.result()
+        except Exception as e:  # noqa: BLE001 reported in the result
+            state = context.state(item)
+            state.status = "failed"
+            state.error = str(e)
+
+
+def _ignore(*_: object) -> None:
+    """Print nothing."""
+
+
+def _progress(context: _Context, message: str) -> None:
+    """Print a progress message, unless the run is quiet."""
+    if not context.quiet:
+        print(message)
+
+
+def _result(item: Item, state: _State) -> Result:
+    """Return the public result for a processed item."""
+    return Result(
+        name=item.name,
+        url=item.url,
+        status=state.status,
+        target=item.target,
+        outputs=state.outputs,
+        downloaded=item.downloaded,
+        bytes_transferred=state.transferred,
+        size=state.size,
+        timings=dict(state.timings),
+        error=state.error,
+        version_output=state.version_output,
+    )
+
+
+def _context(args: _CustomNamespace, *, quiet: bool = False) -> _Context:
+    """Create the context for a run from the command line options."""
+    return _Context(
+        link=getattr(LinkMode, args.link_mode),
+        remote_zip=bool(args.remote_zip),
+        stream=args.no_cache,
+        quiet=quiet,
+        retries=args.retries,
+        retry_delay=args.retry_delay,
+    )
+
+
+def _item(name: str, record: dict, args: _CustomNamespace) -> Item:
+    """Create an item from a record in the input."""
+    item = Item()
+    item.name = name
+    item.url = record["url"]
+    default = args.output.joinpath(name)
+    item.target = Path(record.get("target", default)).expanduser()
+    item.ignore = record.get("ignore", set())
+    item.tags = set(record.get("tags", ()))
+    item.expected = record.get("expected")
+    item.version = record.get("version", "")
+    item.prefix = record.get("prefix", "")
+    if item.prefix and item.prefix[-1] != "/":
+        item.prefix += "/"
+    item.command = record.get("command")
+    item.tree = None
+    item.retries = record.get("retries")
+    item.retry_delay = record.get("retry_delay")
+
+    if "action" in record:
+        item.action = getattr(Action, record["action"])
+    else:
+        item.action = _guess_action(item)
+    item.sniff = "action" not in record and item.action == Action.copy
+
+    if item.url.startswith(_REMOTE):
+        item.downloaded = args.cache.expanduser() / item.url.rsplit("/", 1)[1]
+    else:
+        item.downloaded = Path(item.url)
+    return item
 
-def _display(item: Item) -> None:
+
+def _display(item: Item, context: _Context) -> None:
     """Display the result of processing an item."""
     arg0 = str(item.target.absolute())
     prompt = "#" if item.version else "$"
@@ -113,33 +897,557 @@ def _display(item: Item) -> None:
     else:
         destination = str(item.target.parent).replace(_HOME, "~")
         print(f"$ {destination} now contains {item.name}")
-    if item.version:
-        run([arg0, *split(item.version)], check=True)
+    print(context.state(item).version_output, end="")
     print()
 
 
-def _process(item: Item) -> None:
-    """Context manager to download and install a program."""
-    if not item.downloaded.is_file() and item.url.startswith("https://"):
-        _download(item)
+def _version(item: Item) -> str:
+    """Run the target to check its version, returning the output."""
+    from shlex import split
+    from subprocess import PIPE, run, STDOUT
 
-    if item.expected:
-        with item.downloaded.open("rb") as f:
-            _digest = "sha512" if len(item.expected) == _SHA512_LENGTH else "sha256"
-            digest = file_digest(f, _digest)
+    args = [str(item.target.absolute()), *split(item.version)]
+    return run(args, check=True, stdout=PIPE, stderr=STDOUT, text=True).stdout
 
-        if (actual := digest.hexdigest()) != item.expected:
-            msg = f"Unexpected digest for {item.downloaded}: {actual=} {item.expected=}"
-            raise RuntimeError(msg)
 
-    item.target.parent.mkdir(parents=True, exist_ok=True)
-    item.target.unlink(missing_ok=True)
-    _action(item)
-    if item.target.exists() and not item.target.is_symlink():
-        item.target.chmod(item.target.stat().st_mode | S_IEXEC)
+def _display_download(item: Item) -> None:
+    """Display where an item was downloaded to."""
+    print(f"$ {item.name} is in {str(item.downloaded).replace(_HOME, '~')}")
+
+
+def _export_bundle(path: Path, items: list[Item], cache: _Cache) -> int:
+    """Write the downloads for items to a tar file with an index by URL.
+
+    Returns the number of downloads written.
+    """
+    from tarfile import open as tar_open, TarInfo
+    from tempfile import NamedTemporaryFile
+
+    index: dict[str, str] = {}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with (
+        NamedTemporaryFile(dir=path.parent, delete=False) as file,
+        tar_open(fileobj=file, mode="w") as tar,
+    ):
+        for item in items:
+            digest = cache.digest(item)
+            if digest is None or not cache.blob(digest).is_file():
+                continue
+            if digest not in index.values():
+                tar.add(cache.blob(digest), arcname=f"sha256/{digest}")
+            index[item.url] = digest
+        data = dumps(index, sort_keys=True).encode()
+        info = TarInfo(_INDEX)
+        info.size = len(data)
+        tar.addfile(info, BytesIO(data))
+    Path(file.name).replace(path)
+    return len(set(index.values()))
+
+
+def _import_bundle(path: Path, cache: _Cache) -> int:
+    """Add the downloads in a tar file from _export_bundle to the cache.
+
+    The digest of every file is checked. Returns the number of files added.
+    """
+    from hashlib import new
+    from tarfile import open as tar_open
+    from tempfile import NamedTemporaryFile
+
+    count = 0
+    index: dict[str, str] = {}
+    with tar_open(path, "r|") as tar:
+        for member in tar:
+            if member.name == _INDEX and (file := tar.extractfile(member)):
+                index = loads(file.read())
+                continue
+            digest = member.name.removeprefix("sha256/")
+            if not member.isfile() or digest == member.name:
+                continue
+            if (file := tar.extractfile(member)) is None:
+                continue
+            with NamedTemporaryFile(dir=cache.directory, delete=False) as dp:
+                hash_ = new("sha256")
+                while chunk := file.read(_CHUNK_SIZE):
+                    hash_.update(chunk)
+                    dp.write(chunk)
+            if hash_.hexdigest() != digest:
+                Path(dp.name).unlink()
+                msg = f"Unexpected digest for {member.name} in {path}"
+                raise RuntimeError(msg)
+            cache.store(Path(dp.name), digest)
+            Path(dp.name).unlink(missing_ok=True)
+            count += 1
+    for url, digest in index.items():
+        if cache.blob(digest).is_file():
+            cache.index[url] = digest
+    return count
+
+
+@contextmanager
+def _timed(phase: str, *states: _State) -> Iterator[None]:
+    """Add the time spent in a phase of processing to the timings of items."""
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = perf_counter() - start
+        for state in states:
+            state.timings[phase] = state.timings.get(phase, 0) + elapsed
+
+
+def _summarize(
+    args: _CustomNamespace,
+    items: list[Item],
+    context: _Context,
+    elapsed: float,
+) -> None:
+    """Write the report and print the profile if requested."""
+    if args.report:
+        _write_report(args.report, items, context, elapsed)
+    if args.profile:
+        _print_profile(items, context)
+
+
+def _write_report(
+    path: Path,
+    items: list[Item],
+    context: _Context,
+    elapsed: float,
+) -> None:
+    """Write a machine-readable report of the run as JSON."""
+    results = []
+    for item in items:
+        state = context.state(item)
+        result = {
+            "name": item.name,
+            "url": item.url,
+            "action": item.action.name,
+            "target": str(item.target),
+            "status": state.status,
+            "cache_hit": state.status in ("current", "cached"),
+            "bytes_transferred": state.transferred,
+            "timings": state.timings,
+        }
+        if state.size is not None and state.timings.get("action"):
+            result["decompression_bytes_per_second"] = (
+                state.size / state.timings["action"]
+            )
+        if state.error is not None:
+            result["error"] = state.error
+        results.append(result)
+    report = {"version": __version__, "elapsed": elapsed, "items": results}
+    path.expanduser().write_text(dumps(report, indent=2) + "\n")
+
+
+def _print_profile(items: list[Item], context: _Context) -> None:
+    """Print the time spent in each phase for each item to standard error."""
+    for item in items:
+        state = context.state(item)
+        timings = " ".join(f"{k}={v:.3f}s" for k, v in state.timings.items())
+        summary = f"{item.name}: {state.status} {state.transferred}B {timings}"
+        print(summary, file=sys.stderr)
+
+
+def _process(  # noqa: PLR0913 each store for the run is separate
+    items: list[Item],
+    context: _Context,
+    manifest: _Manifest,
+    cache: _Cache,
+    digests: _Digests,
+    *,
+    pool: Executor | None = None,
+) -> None:
+    """Download and install programs from one URL unless they are current.
+
+    The URL is downloaded and verified once. Items that share an archive are
+    unpacked in a single pass over it, into trees in the cache that later runs
+    reuse. If there is a pool, extraction and decompression are submitted to it.
+    Version checks also run here, so that checks run in parallel with --jobs.
+    """
+    pending = []
+    for item in items:
+        state = context.state(item)
+        with _timed("total", state):
+            source = _prepare(item, context, manifest, cache, digests)
+            if state.status == "current":
+                continue
+            manifest.forget(item)
+            if source is not None:
+                with source:
+                    manifest.record(item, _install([item], context, source)[0])
+                state.transferred += source.raw.transferred
+            else:
+                pending.append(item)
+
+    if pending:
+        with _timed("total", *map(context.state, pending)):
+            outputs = _install_in_pool(pending, context, pool)
+        for item, paths in zip(pending, outputs, strict=True):
+            manifest.record(item, paths)
+            if item.tree is not None:
+                cache.used(item.tree)
+
+    for item in items:
+        state = context.state(item)
+        state.outputs = manifest.outputs(item)
+        if item.version:
+            with _timed("version", state):
+                if (output := manifest.version(item)) is None:
+                    output = _version(item)
+                    manifest.record_version(item, output)
+                state.version_output = output
+
+
+def _prepare(
+    item: Item,
+    context: _Context,
+    manifest: _Manifest | None,
+    cache: _Cache,
+    digests: _Digests,
+) -> _RangeBufferedReader | None:
+    """Download and verify an item, returning a source if it is read remotely.
+
+    Sets the status to current if the item does not need installing, which is
+    never the case without a manifest.
+    """
+    state = context.state(item)
+    algorithm = _algorithm(item.expected)
+    digest = None
+    source = None
+    with cache.lock(item.url):
+        if item.url.startswith(_REMOTE):
+            item.downloaded = cache.lookup(item) or item.downloaded
+        if manifest and not digests.reverify and manifest.current(item):
+            state.status = "current"
+            return None
+        _sniff(item)
+        state.status = "cached" if item.url.startswith(_REMOTE) else "local"
+        if not item.downloaded.is_file() and item.url.startswith(_REMOTE):
+            if context.stream and item.action in _STREAMED:
+                state.status = "streamed"  # downloaded and verified by _install
+                return None
+            with _timed("download", state):
+                digest, source = _fetch(item, context, cache)
+            _sniff(item)
+            state.status = "downloaded" if source is None else "remote"
+            if digest is not None:
+                digests.record(item.downloaded, algorithm, digest)
+
+    with _timed("digest", state):
+        if item.expected and digest is None:
+            _verify(item, _hash(item.downloaded, algorithm, digests))
+
+        if item.action in _CPU_BOUND and source is None:
+            sha256 = cache.named(item.downloaded)  # verified when it was stored
+            if sha256 is None:
+                sha256 = _hash(item.downloaded, "sha256", digests)
+            item.tree = cache.tree(item, sha256)
+
+    if item.tree is not None and not item.tree.is_dir():
+        state.size = item.downloaded.stat().st_size
+    return source
+
+
+def _prefetch(
+    items: list[Item],
+    context: _Context,
+    cache: _Cache,
+    digests: _Digests,
+) -> None:
+    """Download and verify items into the cache without installing them."""
+    # the whole file is needed in the cache
+    context = replace(context, remote_zip=False, stream=False)
+    for item in items:
+        with _timed("total", context.state(item)):
+            _prepare(item, context, None, cache, digests)
+
+
+def _install(
+    items: list[Item],
+    context: _Context,
+    source: BinaryIO | None = None,
+) -> list[list[Path]]:
+    """Replace the targets using the action, returning the paths created.
+
+    Several items must share an archive, which is then read once for all of
+    them. Source is only used with a single item. Streamed files replace the
+    targets once verified, so a failed download leaves the old files in place.
+    """
+    states = [context.state(i) for i in items]
+    streamed = states[0].status == "streamed"
+    with _timed("unlink", *states):
+        for item in items:
+            item.target.parent.mkdir(parents=True, exist_ok=True)
+            if not streamed:
+                item.target.unlink(missing_ok=True)
+    with _timed("action", *states):
+        if streamed:
+            outputs = _stream(items, context)
+        elif items[0].tree is not None:
+            outputs = _from_trees(items, context)
+        elif len(items) == 1:
+            outputs = [_action(items[0], context, source)]
+        else:
+            outputs = _many_files([(i, i.target.parent) for i in items])
+    with _timed("chmod", *states):
+        for item in items:
+            if item.target.exists() and not item.target.is_symlink():
+                item.target.chmod(item.target.stat().st_mode | S_IEXEC)
+    for item, paths in zip(items, outputs, strict=True):
+        if item.target.exists() or item.target.is_symlink():
+            paths.append(item.target)
+    return outputs
+
+
+def _stream(items: list[Item], context: _Context) -> list[list[Path]]:
+    """Install items from one URL straight from the response, with retries.
+
+    The files are written to a staging directory next to each target and only
+    moved into place after the length and digest are checked.
+    """
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    attempt = 0
+    while True:
+        stagings = [Path(mkdtemp(dir=i.target.parent, prefix=".")) for i in items]
+        try:
+            return _stream_once(items, context, stagings)
+        except _transient() as e:
+            _backoff(items[0], context, e, attempt)
+            attempt += 1
+        finally:
+            for staging in stagings:
+                rmtree(staging, ignore_errors=True)
+
+
+def _stream_once(
+    items: list[Item],
+    context: _Context,
+    stagings: list[Path],
+) -> list[list[Path]]:
+    """Stream one attempt into the staging directories then commit the files."""
+    from shutil import copyfileobj
+
+    item = items[0]
+    with _CONNECTIONS.open(item.url) as response:
+        _progress(context, f"Streaming {item.name}…")
+        reader = _HashingReader(item, response, context.state(item))
+        with BufferedReader(reader, _CHUNK_SIZE) as source:
+            if item.action == Action.untar:
+                staged = _many_files(list(zip(items, stagings, strict=True)), source)
+            elif item.action in _SINGLE:
+                _decompress(item.action, source, stagings[0] / _FILE)
+                staged = [[stagings[0] / _FILE]]
+            else:
+                with (stagings[0] / _FILE).open("wb") as file:
+                    copyfileobj(source, file)
+                staged = [[stagings[0] / _FILE]]
+            reader.finish()
+
+    if item.action != Action.untar:
+        staged[0][0].replace(item.target)
+        return [[]]
+    outputs: list[list[Path]] = []
+    for item, staging, paths in zip(items, stagings, staged, strict=True):
+        outputs.append([])
+        for path in paths:
+            destination = item.target.parent / path.relative_to(staging)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            path.replace(destination)
+            outputs[-1].append(destination)
+    return outputs
+
+
+def _install_in_pool(
+    items: list[Item],
+    context: _Context,
+    pool: Executor | None,
+) -> list[list[Path]]:
+    """Install items in the pool if there is one and the action uses the CPU."""
+    if pool is None or items[0].action not in _CPU_BOUND or context.stream:
+        return _install(items, context)
+    outputs, timings = pool.submit(_install_in_process, items, context).result()
+    for item, i in zip(items, timings, strict=True):
+        context.state(item).timings |= i
+    return outputs
+
+
+def _install_in_process(
+    items: list[Item],
+    context: _Context,
+) -> tuple[list[list[Path]], list[dict[str, float]]]:
+    """Install in another process, also returning the timings."""
+    return _install(items, context), [context.state(i).timings for i in items]
+
+
+def _fetch(
+    item: Item,
+    context: _Context,
+    cache: _Cache,
+) -> tuple[str | None, _RangeBufferedReader | None]:
+    """Download an item or open it remotely, retrying transient network errors.
+
+    Returns the hex-digest of a download or a remote zip file.
+    """
+    attempt = 0
+    while True:
+        try:
+            if (source := _open_remote_zip(item, context)) is not None:
+                return None, source
+            return _download(item, cache, context), None
+        except _transient() as e:
+            _backoff(item, context, e, attempt)
+            attempt += 1
+
+
+def _transient() -> tuple[type[Exception], ...]:
+    """Return the errors that may be temporary, so are worth retrying."""
+    from http.client import HTTPException
+    from socket import gaierror
+    from urllib.error import URLError
+
+    return (ConnectionError, TimeoutError, HTTPException, URLError, gaierror)
+
+
+def _backoff(item: Item, context: _Context, error: Exception, attempt: int) -> None:
+    """Wait before retrying after an error or raise it if it is not retried.
+
+    The number of retries and the first delay for the item override the options.
+    """
+    retries = context.retries if item.retries is None else item.retries
+    base = context.retry_delay if item.retry_delay is None else item.retry_delay
+    delay = _delay(error, attempt, base)
+    if attempt >= retries or delay is None:
+        raise error
+    _progress(context, f"Retrying {item.name} in {delay:.1f}s after: {error}")
+    sleep(delay)
+
+
+def _delay(error: Exception, attempt: int, base: float) -> float | None:
+    """Return seconds to wait before retrying or None if it should not be retried.
+
+    Uses exponential backoff with jitter unless the server sent Retry-After.
+    Client errors other than 429 Too Many Requests are not retried.
+    """
+    from email.utils import parsedate_to_datetime
+    from random import uniform
+    from urllib.error import HTTPError
+
+    if isinstance(error, HTTPError):
+        if error.code == HTTPStatus.TOO_MANY_REQUESTS and error.headers:
+            if (retry_after := error.headers.get("Retry-After", "")).isdigit():
+                return min(float(retry_after), _MAX_DELAY)
+            with suppress(TypeError, ValueError):
+                wait = parsedate_to_datetime(retry_after).timestamp() - time()
+                return min(max(wait, 0), _MAX_DELAY)
+        elif error.code < HTTPStatus.INTERNAL_SERVER_ERROR:
+            return None
+    backoff = min(base * 2**attempt, _MAX_DELAY)
+    return uniform(backoff / 2, backoff)  # noqa: S311 jitter is not cryptographic
+
+
+def _hash(path: Path, algorithm: str, digests: _Digests) -> str:
+    """Return the hex-digest of a file, unless it is unchanged since last time."""
+    if (digest := digests.get(path, algorithm)) is None:
+        from hashlib import file_digest
+
+        with path.open("rb") as f:
+            digest = file_digest(f, algorithm).hexdigest()
+        digests.record(path, algorithm, digest)
+    return digest
+
+
+def _sha256(data: bytes) -> str:
+    """Return the SHA256 hex-digest of data, used for names in the cache."""
+    from hashlib import sha256
+
+    return sha256(data).hexdigest()
+
+
+def _inputs(item: Item) -> list:
+    """Return everything that determines the result of processing an item.
+
+    A sniffed action follows from the download, so it is not included and
+    --check can compare the inputs without reading any files.
+    """
+    return [
+        item.url,
+        item.expected,
+        "sniff" if item.sniff else item.action.name,
+        item.prefix,
+        sorted(item.ignore),
+        item.command,
+        _fingerprint(item.downloaded),
+    ]
+
+
+def _version_key(item: Item) -> list:
+    """Return what determines the output of the version check for an item."""
+    return [item.version, _fingerprint(item.target.resolve())]
+
+
+def _fingerprint(path: Path) -> list[int] | None:
+    """Return size, modification time and inode for a path, without following."""
+    try:
+        stat = path.lstat()
+    except FileNotFoundError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def _load_json(path: Path) -> dict:
+    """Read a JSON object from a file, returning an empty dictionary on failure."""
+    try:
+        data = loads(path.read_text())
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def _save_json(path: Path, data: dict) -> None:
+    """Atomically write a JSON object to a file."""
+    from tempfile import NamedTemporaryFile
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with NamedTemporaryFile("w", dir=path.parent, delete=False) as file:
+        file.write(dumps(data, sort_keys=True))
+    Path(file.name).replace(path)
+
+
+def _update_json(path: Path, data: dict, removed: set[str] | None = None) -> None:
+    """Merge a JSON object into a file, keeping entries from other processes.
+
+    Keys in removed are deleted from the file, unless they are also in data.
+    """
+    with _locked(path.parent / _LOCKS / f"{path.name}.lock"):
+        merged = _load_json(path) | data
+        for key in (removed or set()) - data.keys():
+            merged.pop(key, None)
+        _save_json(path, merged)
+
+
+@contextmanager
+def _locked(path: Path, operation: int = LOCK_EX) -> Iterator[int]:
+    """Hold an advisory lock on path, yielding the file descriptor.
+
+    Each call opens the file again, so the lock also excludes other threads.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a") as file:
+        flock(file, operation)
+        yield file.fileno()
 
 
 def _parse_args(args: list[str] | None) -> _CustomNamespace:
+    parser = _parser()
+    help_ = "input specification in TOML"
+    parser.add_argument("input", nargs="+", help=help_, type=Path)
+    return parser.parse_args(args, namespace=_CustomNamespace())
+
+
+def _parser() -> ArgumentParser:
+    """Return a parser for the options, without the input files."""
     parser = ArgumentParser(prog=Path(__file__).name)
     parser.add_argument("--version", action="version", version=__version__)
     help_ = f"Target directory (default: {_OUTPUT})"
@@ -148,80 +1456,544 @@ def _parse_args(args: list[str] | None) -> _CustomNamespace:
     parser.add_argument("--cache", default=_CACHE, help=help_, type=Path)
     help_ = "Clear the cache directory first (default: --no-clear)"
     parser.add_argument("--clear", action=BooleanOptionalAction, help=help_)
-    help_ = "input specification in TOML"
-    parser.add_argument("input", nargs="+", help=help_, type=Path)
-    return parser.parse_args(args, namespace=_CustomNamespace())
+    help_ = "Number of items to process in parallel (default: 1)"
+    parser.add_argument("--jobs", default=1, help=help_, type=_positive)
+    help_ = "Evict least recently used downloads above this size, for example 2G"
+    parser.add_argument("--cache-max-size", help=help_, type=_size)
+    help_ = "Evict downloads not used for this many days"
+    parser.add_argument("--cache-max-age", help=help_, type=_positive)
+    help_ = "How to install copied or extracted files, auto tries reflink, hardlink "
+    help_ += "then copy; linked files share storage with the cache (default: copy)"
+    choices = [i.name for i in LinkMode]
+    parser.add_argument("--link-mode", choices=choices, default="copy", help=help_)
+    help_ = "Only download selected files from zip files without an expected digest, "
+    help_ += "using HTTP range requests (default: --no-remote-zip)"
+    parser.add_argument("--remote-zip", action=BooleanOptionalAction, help=help_)
+    help_ = "Times to retry a download after a transient error (default: 3)"
+    parser.add_argument("--retries", default=3, help=help_, type=int)
+    help_ = "Seconds before the first retry, doubling each time (default: 1)"
+    parser.add_argument("--retry-delay", default=1.0, help=help_, type=float)
+    help_ = "Write timings and statistics for each item to this JSON file"
+    parser.add_argument("--report", help=help_, type=Path)
+    help_ = "Print timings for each item to standard error (default: --no-profile)"
+    parser.add_argument("--profile", action=BooleanOptionalAction, help=help_)
+    help_ = "Install without keeping downloads, streaming archives where possible"
+    parser.add_argument("--no-cache", action="store_true", help=help_)
+    help_ = (
+        "Only download and verify items into the cache (default: --no-download-only)"
+    )
+    parser.add_argument("--download-only", action=BooleanOptionalAction, help=help_)
+    help_ = "Download items then write them to this tar file, instead of installing"
+    parser.add_argument("--export-bundle", help=help_, type=Path)
+    help_ = "Add downloads from a tar file written with --export-bundle to the cache"
+    parser.add_argument("--import-bundle", help=help_, type=Path)
+    help_ = "Hash files even if unchanged since last verified (default: --no-reverify)"
+    parser.add_argument("--reverify", action=BooleanOptionalAction, help=help_)
+    help_ = "Only evict downloads from the cache, do not install (default: --no-gc)"
+    parser.add_argument("--gc", action=BooleanOptionalAction, help=help_)
+    help_ = "Only process items with a name or tag matching this glob, can be repeated"
+    parser.add_argument("--only", action="append", help=help_, metavar="GLOB")
+    help_ = "Skip items with a name or tag matching this glob, can be repeated"
+    parser.add_argument("--exclude", action="append", help=help_, metavar="GLOB")
+    help_ = "Only report which items are missing, stale or up to date, using stat "
+    help_ += "without downloading or locking the cache (default: --no-check)"
+    parser.add_argument("--check", "--plan", action=BooleanOptionalAction, help=help_)
+    return parser
+
 
+def _positive(value: str) -> int:
+    """Convert a command line argument to a positive integer."""
+    if not value.isdigit() or (result := int(value)) < 1:
+        msg = f"invalid positive integer: {value!r}"
+        raise ArgumentTypeError(msg)
+    return result
 
-def _download(item: Item) -> None:
-    item.downloaded.parent.mkdir(parents=True, exist_ok=True)
-    with urlopen(item.url) as fp, item.downloaded.open("wb") as dp:
-        size = int(fp.headers.get("Content-Length", -1))
-        print(f"Downloading {item.name}…")
-        written = dp.write(fp.read())
 
-    if size >= 0 and written != size:
-        msg = "Wrong content length"
+def _algorithm(expected: str | None) -> str:
+    """Return the name of the hash algorithm for an expected hex-digest."""
+    if expected is not None and len(expected) == _SHA512_LENGTH:
+        return "sha512"
+    return "sha256"
+
+
+def _verify(item: Item, actual: str, source: Path | str | None = None) -> None:
+    """Raise an error if a hex-digest is not the expected value.
+
+    Source names what was hashed in the message, by default item.downloaded.
+    """
+    if item.expected and actual != item.expected:
+        source = item.downloaded if source is None else source
+        msg = f"Unexpected digest for {source}: {actual=} {item.expected=}"
         raise RuntimeError(msg)
 
 
-def _action(item: Item) -> None:
+def _size(value: str) -> int:
+    """Convert a command line argument like 512M or 2G to a number of bytes."""
+    number, unit = value.rstrip("KMGTkmgt"), value.lstrip("0123456789").upper()
+    if not number.isdigit() or unit not in _UNITS:
+        msg = f"invalid size: {value!r}"
+        raise ArgumentTypeError(msg)
+    return int(number) * _UNITS[unit]
+
+
+def _download(item: Item, cache: _Cache, context: _Context) -> str:
+    """Stream item.url into the cache, checking length and digest on the way.
+
+    Data is written to a partial file that is only added to the cache once
+    both checks pass. If a previous download was interrupted it is resumed
+    with a range request. Returns the hex-digest using the algorithm for
+    item.expected.
+    """
+    part = cache.partial(item.url)
+    part.parent.mkdir(parents=True, exist_ok=True)
+    validator = part.with_suffix(".json")
+    algorithm = _algorithm(item.expected)
+
+    result = _transfer(item, context, part, validator, algorithm)
+    if result is None:  # the partial file cannot be resumed
+        part.unlink(missing_ok=True)
+        validator.unlink(missing_ok=True)
+        result = _transfer(item, context, part, validator, algorithm)
+    if result is None:
+        msg = f"Range not satisfiable downloading {item.url}"
+        raise RuntimeError(msg)
+    size, written, hashes = result
+
+    try:  # a complete download that fails these checks cannot be resumed
+        if size >= 0 and written != size:
+            msg = "Wrong content length"
+            raise RuntimeError(msg)
+        _verify(item, hashes[-1].hexdigest(), item.url)
+        item.downloaded = cache.add(item.url, part, hashes[0].hexdigest())
+    finally:
+        part.unlink(missing_ok=True)
+        validator.unlink(missing_ok=True)
+    return hashes[-1].hexdigest()
+
+
+def _transfer(
+    item: Item,
+    context: _Context,
+    part: Path,
+    validator: Path,
+    algorithm: str,
+) -> tuple[int, int, list] | None:
+    """Write the response for item.url to part, resuming it if possible.
+
+    Returns the expected size or -1, the bytes written and the hashes, SHA256
+    first. Returns None if the server cannot resume from the end of part,
+    either responding 416 or with a range starting somewhere else.
+    """
+    from hashlib import new
+    from urllib.error import HTTPError
+
+    hashes = [new("sha256")]
+    if algorithm != "sha256":
+        hashes.append(new(algorithm))
+    headers = _resume_headers(item, part, validator)
+    try:
+        with _CONNECTIONS.open(item.url, headers) as fp:
+            offset = 0
+            if headers and fp.status == HTTPStatus.PARTIAL_CONTENT:
+                offset = part.stat().st_size
+                if _range_start(fp.headers.get("Content-Range", "")) != offset:
+                    return None
+                _progress(context, f"Resuming download of {item.name}…")
+                with part.open("rb") as f:
+                    while chunk := f.read(_CHUNK_SIZE):
+                        for hash_ in hashes:
+                            hash_.update(chunk)
+            else:
+                _progress(context, f"Downloading {item.name}…")
+            etag = fp.headers.get("ETag", "W/")
+            value = fp.headers.get("Last-Modified") if etag.startswith("W/") else etag
+            _save_json(validator, {"If-Range": value} if value else {})
+            size = int(fp.headers.get("Content-Length", -1))
+            written = 0
+            try:
+                with part.open("ab" if offset else "wb") as dp:
+                    while chunk := fp.read(_CHUNK_SIZE):
+                        for hash_ in hashes:
+                            hash_.update(chunk)
+                        written += dp.write(chunk)
+            finally:
+                context.state(item).transferred += written
+    except HTTPError as e:
+        if headers and e.code == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE:
+            return None
+        raise
+    return size, written, hashes
+
+
+def _range_start(content_range: str) -> int | None:
+    """Return the first byte from a Content-Range header like bytes 0-9/10."""
+    with suppress(ValueError):
+        return int(content_range.removeprefix("bytes ").split("-")[0])
+    return None
+
+
+def _resume_headers(item: Item, part: Path, validator: Path) -> dict[str, str]:
+    """Return headers to resume a partial download, if that is possible.
+
+    Without an If-Range validator from the server, a download is only resumed
+    if the expected digest will catch a mismatch.
+    """
+    if not part.is_file() or not (offset := part.stat().st_size):
+        return {}
+    headers = {"Range": f"bytes={offset}-"} | _load_json(validator)
+    return headers if "If-Range" in headers or item.expected else {}
+
+
+class _RangeReader(RawIOBase):
+    """Read-only file backed by HTTP range requests."""
+
+    def __init__(self, url: str, size: int) -> None:
+        self.url = url
+        self.size = size
+        self.position = 0
+        self.transferred = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        start = {SEEK_SET: 0, SEEK_CUR: self.position, SEEK_END: self.size}[whence]
+        self.position = start + offset
+        return self.position
+
+    def readinto(self, buffer: WriteableBuffer, /) -> int:
+        view = memoryview(buffer).cast("B")
+        end = min(self.position + len(view), self.size)
+        if self.position >= end:
+            return 0
+        headers = {"Range": f"bytes={self.position}-{end - 1}"}
+        with _CONNECTIONS.open(self.url, headers) as response:
+            if response.status != HTTPStatus.PARTIAL_CONTENT:
+                msg = f"Range request ignored for {self.url}"
+                raise RuntimeError(msg)
+            data = response.read()
+        view[: len(data)] = data
+        self.position += len(data)
+        self.transferred += len(data)
+        return len(data)
+
+
+class _HashingReader(RawIOBase):
+    """Read-only file over an HTTP response that hashes and counts the data."""
+
+    def __init__(self, item: Item, response: HTTPResponse, state: _State) -> None:
+        from hashlib import new
+
+        self.item = item
+        self.response = response
+        self.state = state
+        self.hash = new(_algorithm(item.expected))
+        self.size = int(response.headers.get("Content-Length", -1))
+        self.transferred = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: WriteableBuffer, /) -> int:
+        count = self.response.readinto(buffer)
+        self.hash.update(memoryview(buffer).cast("B")[:count])
+        self.transferred += count
+        self.state.transferred += count
+        return count
+
+    def finish(self) -> None:
+        """Read any remaining data then check the length and digest."""
+        while self.read(_CHUNK_SIZE):
+            pass
+        if self.size >= 0 and self.transferred != self.size:
+            msg = "Wrong content length"
+            raise RuntimeError(msg)
+        _verify(self.item, self.hash.hexdigest(), self.item.url)
+
+
+class _RangeBufferedReader(BufferedReader):
+    """A buffered _RangeReader."""
+
+    raw: _RangeReader
+
+
+def _open_remote_zip(item: Item, context: _Context) -> _RangeBufferedReader | None:
+    """Open a zip file on a server that supports range requests.
+
+    Only used for unzip items in remote zip mode without an expected digest;
+    because the digest is for the whole file. Returns None otherwise, or if
+    the server ignores the range header.
+    """
+    if not context.remote_zip or item.action != Action.unzip or item.expected:
+        return None
+    with _CONNECTIONS.open(item.url, {"Range": "bytes=0-0"}) as response:
+        total = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+        if response.status != HTTPStatus.PARTIAL_CONTENT or not total.isdigit():
+            return None
+        response.read()
+    _progress(context, f"Downloading selected files from {item.name}…")
+    return _RangeBufferedReader(_RangeReader(item.url, int(total)), _CHUNK_SIZE)
+
+
+def _action(
+    item: Item,
+    context: _Context,
+    source: BinaryIO | None = None,
+) -> list[Path]:
+    """Install an item, returning any paths created other than the target.
+
+    If source is not None it is read instead of item.downloaded.
+    """
     if item.action == Action.copy:
-        copy(item.downloaded, item.target)
+        _link(item.downloaded, item.target, context.link)
     elif item.action == Action.symlink:
         item.target.symlink_to(item.downloaded)
-    elif item.action == Action.gunzip:
-        with GzipFile(item.downloaded, "r") as fsrc, item.target.open("wb") as fdst:
-            copyfileobj(fsrc, fdst)
+    elif item.action in _SINGLE:
+        _decompress(item.action, item.downloaded, item.target)
     elif item.action in (Action.unzip, Action.untar):
-        _many_files(item)
+        return _many_files([(item, item.target.parent)], source)[0]
     elif item.action == Action.command and item.command is not None:
+        from shlex import split
+        from subprocess import run
+
         cmd = item.command.format(target=item.target, downloaded=item.downloaded)
         run(split(cmd), check=True)
+    return []
 
 
-def _many_files(item: Item) -> None:
-    """Unzip or untar an item.
+def _link(source: Path, destination: Path, mode: LinkMode) -> None:
+    """Create destination with the contents of source.
 
-    These two actions should respect 'ignore' and 'prefix' similarly.
+    The auto mode tries a copy-on-write clone, then a hard link and finally
+    falls back to copying.
     """
-    ignored = [item.prefix + i for i in item.ignore]
+    if mode in (LinkMode.auto, LinkMode.reflink):
+        try:
+            _reflink(source, destination)
+        except OSError:
+            if mode == LinkMode.reflink:
+                raise
+        else:
+            return
+    if mode in (LinkMode.auto, LinkMode.hardlink):
+        try:
+            destination.hardlink_to(source)
+        except OSError:
+            if mode == LinkMode.hardlink:
+                raise
+        else:
+            return
+    from shutil import copy
 
-    def _should_continue(filename: str) -> bool:
-        return any(
-            [
-                filename in ignored,
-                filename == item.prefix,
-                item.prefix != "" and not filename.startswith(item.prefix),
-            ],
-        )
+    copy(source, destination)
+
+
+def _reflink(source: Path, destination: Path) -> None:
+    """Clone source to destination, if the file system supports it."""
+    with source.open("rb") as src, destination.open("xb") as dst:
+        try:
+            ioctl(dst.fileno(), _FICLONE, src.fileno())
+        except OSError:
+            destination.unlink()
+            raise
+    from shutil import copymode
+
+    copymode(source, destination)
+
+
+def _from_trees(items: list[Item], context: _Context) -> list[list[Path]]:
+    """Unpack any missing trees in one pass, then link files into place."""
+    missing = {i.tree: i for i in items if i.tree is not None and not i.tree.is_dir()}
+    if missing:
+        _unpack(list(missing.values()))
+    return [_from_tree(i, i.tree, context.link) for i in items if i.tree is not None]
+
+
+def _from_tree(item: Item, tree: Path, link: LinkMode) -> list[Path]:
+    """Link or copy files into place from the unpacked archive in the cache."""
+    if item.action in _SINGLE:
+        _link(tree / _FILE, item.target, link)
+        return []
+
+    outputs: list[Path] = []
+    for source in sorted(tree.rglob("*")):  # sorted so parents come first
+        destination = item.target.parent / source.relative_to(tree)
+        if source.is_dir() and not source.is_symlink():
+            destination.mkdir(exist_ok=True)
+            continue
+        destination.unlink(missing_ok=True)
+        if source.is_symlink():
+            destination.symlink_to(source.readlink())
+        else:
+            _link(source, destination, link)
+        outputs.append(destination)
+    return outputs
+
+
+def _unpack(items: list[Item]) -> None:
+    """Unpack the archive shared by items into their trees, in one pass."""
+    from shutil import rmtree
+    from tempfile import mkdtemp
+
+    trees = [i.tree for i in items if i.tree is not None]
+    routes = []
+    for item, tree in zip(items, trees, strict=True):
+        tree.parent.mkdir(parents=True, exist_ok=True)
+        routes.append((item, Path(mkdtemp(dir=tree.parent))))
+    try:
+        if items[0].action in _SINGLE:
+            _decompress(items[0].action, items[0].downloaded, routes[0][1] / _FILE)
+        else:
+            _many_files(routes)
+        for (_, temporary), tree in zip(routes, trees, strict=True):
+            with suppress(OSError):  # another process may have unpacked it first
+                temporary.rename(tree)
+    finally:
+        for _, temporary in routes:
+            rmtree(temporary, ignore_errors=True)
+
+
+def _decompress(action: Action, source: Path | BinaryIO, destination: Path) -> None:
+    """Decompress a single file, streaming through a buffer of bounded size.
 
-    file: TarFile | ZipFile
-    member: TarInfo | ZipInfo
+    The output is written to a temporary file that is then renamed, so that
+    destination is never left partly written.
+    """
+    from shutil import copyfileobj
+
+    temporary = destination.with_name(f".{destination.name}.{getpid()}.{get_ident()}")
+    try:
+        with _decompressor(action, source) as fsrc, temporary.open("xb") as fdst:
+            copyfileobj(fsrc, fdst, _CHUNK_SIZE)
+        temporary.replace(destination)
+    finally:
+        temporary.unlink(missing_ok=True)
+
+
+def _decompressor(action: Action, source: Path | BinaryIO) -> BufferedIOBase:
+    """Open source for reading with the decompressor for action."""
+    if action == Action.unxz:
+        from lzma import LZMAFile
+
+        return LZMAFile(source)
+    if action == Action.bunzip2:
+        from bz2 import BZ2File
+
+        return BZ2File(source)
+    from gzip import GzipFile  # reads every member of a multi-member file
+
+    path, fileobj = (source, None) if isinstance(source, Path) else (None, source)
+    return GzipFile(path, "r", fileobj=fileobj)
+
+
+def _sniff(item: Item) -> None:
+    """Set the action from the first bytes of a download without an extension.
+
+    Only applies if the action was not given and nothing else was guessed.
+    """
+    if not item.sniff or not item.downloaded.is_file():
+        return
+    with item.downloaded.open("rb") as file:
+        head = file.read(max(map(len, _MAGIC)))
+    for magic, action in _MAGIC.items():
+        if head.startswith(magic):
+            item.action = action
+
+
+def _many_files(
+    routes: list[tuple[Item, Path]],
+    source: BinaryIO | None = None,
+) -> list[list[Path]]:
+    """Unzip or untar into directories, returning the extracted files for each.
+
+    Each route is an item and a directory for its files. The archive is the
+    download for the first item and is read once for all the routes. These
+    two actions should respect 'ignore' and 'prefix' similarly. If source is
+    not None it is read instead of item.downloaded.
+    """
+    extracted: list[list[Path]] = [[] for _ in routes]
+    item = routes[0][0]
     if item.action == Action.untar:
-        with tar_open(item.downloaded, "r") as file:
-            for member in file.getmembers():
-                if _should_continue(member.name):
-                    continue
-                member.name = member.name.removeprefix(item.prefix)
-                try:
-                    file.extract(member, path=item.target.parent, filter="tar")
-                except TypeError:  # before 3.11.4 e.g. Debian 12
-                    file.extract(member, path=item.target.parent)
+        _untar(source or item.downloaded, routes, extracted)
     else:
-        with ZipFile(item.downloaded, "r") as file:
+        from zipfile import ZipFile
+
+        with ZipFile(source or item.downloaded, "r") as file:
             for member in file.infolist():
-                if _should_continue(member.filename):
+                filename = member.filename
+                for i, (item, directory) in enumerate(routes):
+                    if _skip(item, filename):
+                        continue
+                    member.filename = filename.removeprefix(item.prefix)
+                    path = file.extract(member, path=directory)
+                    if not member.is_dir():
+                        extracted[i].append(Path(path))
+    return extracted
+
+
+def _untar(
+    archive: Path | BinaryIO,
+    routes: list[tuple[Item, Path]],
+    extracted: list[list[Path]],
+) -> None:
+    from shutil import copy2
+    from tarfile import open as tar_open
+
+    # a stream reads and decompresses the archive once, without seeking
+    filename, fileobj = (
+        (archive, None) if isinstance(archive, Path) else (None, archive)
+    )
+    with tar_open(filename, "r|*", fileobj, bufsize=_CHUNK_SIZE) as file:
+        while (member := file.next()) is not None:
+            # next appends each member to a list, even when reading a stream
+            file.members.clear()  # type: ignore[attr-defined]
+            name = member.name
+            first = None
+            for i, (item, directory) in enumerate(routes):
+                if _skip(item, name):
                     continue
-                member.filename = member.filename.removeprefix(item.prefix)
-                file.extract(member, path=item.target.parent)
+                member.name = name.removeprefix(item.prefix)
+                path = directory / member.name.lstrip("/")
+                if first is not None and member.isfile():
+                    # the data in a stream can only be read once so copy it
+                    path.parent.mkdir(parents=True, exist_ok=True)
+                    copy2(first, path)
+                else:
+                    try:
+                        file.extract(member, path=directory, filter="tar")
+                    except TypeError:  # before 3.11.4 e.g. Debian 12
+                        file.extract(member, path=directory)
+                    first = path
+                if not member.isdir():
+                    extracted[i].append(path)
+
+
+def _skip(item: Item, filename: str) -> bool:
+    """Return True if a member of an archive is not wanted for item."""
+    return any(
+        [
+            filename in [item.prefix + i for i in item.ignore],
+            filename == item.prefix,
+            item.prefix != "" and not filename.startswith(item.prefix),
+        ],
+    )
 
 
 def _guess_action(item: Item) -> Action:
-    if item.url.endswith((".tar.xz", ".tar.gz", ".tar")):
+    if item.url.endswith((".tar.xz", ".tar.gz", ".tar.bz2", ".tar")):
         guess = Action.untar
     elif item.url.endswith((".gz",)):
         guess = Action.gunzip
+    elif item.url.endswith(".xz"):
+        guess = Action.unxz
+    elif item.url.endswith(".bz2"):
+        guess = Action.bunzip2
     elif item.url.endswith(".zip"):
         guess = Action.unzip
     elif item.url.startswith("/"):
@@ -4,19 +4,40 @@
 # SPDX-License-Identifier: MPL-2.0
 """Tests for src/dotlocalslashbin.py."""
 
+import asyncio
+import bz2
 import contextlib
+import json
+import lzma
 import os
 import unittest
 from collections.abc import Iterator
 from contextlib import contextmanager
+from gzip import GzipFile
+from hashlib import sha256, sha512
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import StringIO
 from pathlib import Path
-from subprocess import run
+from subprocess import DEVNULL, Popen, run
 from sys import executable
-from tarfile import TarFile
+from tarfile import open as tar_open, ReadError, TarFile, TarInfo
 from tempfile import TemporaryDirectory
-from zipfile import ZipFile
-
-from dotlocalslashbin import main
+from threading import Thread
+from time import sleep, time
+from unittest.mock import patch
+from zipfile import ZIP_STORED, ZipFile
+
+from dotlocalslashbin import (
+    _Cache,
+    _Context,
+    _download,
+    _hash,
+    install,
+    install_async,
+    Item,
+    main,
+)
 
 EXAMPLE_1 = Path("examples/1.toml").absolute()
 EXAMPLE_2 = Path("examples/2.toml").absolute()
@@ -52,7 +73,7 @@ class TestReadme(unittest.TestCase):
 class TestCache(unittest.TestCase):
     """Test behaviour of the cache."""
 
-    def _execute(self, extra: list[str]) -> int:
+    def _execute(self, extra: list[str]) -> bool:
         with TemporaryDirectory() as cache, TemporaryDirectory() as output:
             Path(cache).joinpath("was_not_cleared").touch()
             run(
@@ -67,22 +88,19 @@ class TestCache(unittest.TestCase):
                 check=True,
                 capture_output=True,
             )
-            return sum(1 for _ in Path(cache).iterdir())
+            return Path(cache).joinpath("was_not_cleared").exists()
 
     def test_example_without_clear(self) -> None:
         """Check that the cache is not cleared by default."""
-        count = self._execute([])
-        self.assertEqual(2, count)
+        self.assertTrue(self._execute([]))
 
     def test_example_with_clear(self) -> None:
         """Check that the cache is cleared."""
-        count = self._execute(["--clear"])
-        self.assertEqual(1, count)
+        self.assertFalse(self._execute(["--clear"]))
 
     def test_example_with_no_clear(self) -> None:
         """Check that the cache is not cleared."""
-        count = self._execute(["--no-clear"])
-        self.assertEqual(2, count)
+        self.assertTrue(self._execute(["--no-clear"]))
 
 
 class TestInputs(unittest.TestCase):
@@ -123,12 +141,12 @@ def _directory(prefix: str) -> Iterator[Path]:
 
 
 @contextmanager
-def call(toml: str, cache: Path) -> Iterator[Path]:
+def call(toml: str, cache: Path, extra: list[str] | None = None) -> Iterator[Path]:
     """Wrap main yielding a temporary output directory."""
     with _directory("input_") as directory, _directory("output_") as output:
         _input = directory / "input.toml"
         _input.write_text(toml)
-        args = [f"--output={output}", f"--cache={cache}", f"{_input}"]
+        args = [f"--output={output}", f"--cache={cache}", *(extra or []), f"{_input}"]
         with Path(os.devnull).open("w") as f, contextlib.redirect_stdout(f):
             main(args)
         yield output
@@ -149,6 +167,101 @@ def _write_zip(
             _zip.write(i, arcname=arcname)
 
 
+class _Handler(BaseHTTPRequestHandler):
+    """Serve files from a directory, optionally supporting range requests.
+
+    Paths starting /redirect/ are redirected to the rest of the path. Each
+    status code in errors is sent in response to one request, before any files.
+    Every response is sent after delay seconds.
+    """
+
+    protocol_version = "HTTP/1.1"  # keep connections alive
+    directory: Path
+    ranges: bool
+    errors: list[int]
+    requests: list[tuple[int, int]]
+    delay: float
+
+    def do_GET(self) -> None:
+        """Respond with the whole file or the requested range."""
+        sleep(self.delay)
+        if self.errors:
+            self.send_response(status := self.errors.pop(0))
+            if status == HTTPStatus.TOO_MANY_REQUESTS:
+                self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.requests.append((self.client_address[1], 0))
+            return
+        if self.path.startswith("/redirect/"):
+            self.send_response(302)
+            self.send_header("Location", self.path.removeprefix("/redirect"))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.requests.append((self.client_address[1], 0))
+            return
+        path = self.directory / self.path.lstrip("/")
+        if not path.is_file():
+            self.send_error(404)
+            return
+        data = path.read_bytes()
+        start, end = 0, len(data) - 1
+        etag = f'"{sha256(data).hexdigest()}"'
+        header = self.headers.get("Range")
+        if self.ranges and header and self.headers.get("If-Range", etag) == etag:
+            first, last = header.removeprefix("bytes=").split("-")
+            start, end = int(first), min(int(last or end), end)
+            if start >= len(data):
+                self.send_error(416)
+                self.requests.append((self.client_address[1], 0))
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+        else:
+            self.send_response(200)
+        body = data[start : end + 1]
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.requests.append((self.client_address[1], len(body)))
+
+    def log_message(self, *_: object) -> None:
+        """Do not log requests."""
+
+
+@contextmanager
+def _serve(
+    directory: Path,
+    *,
+    ranges: bool = True,
+    errors: list[int] | None = None,
+    delay: float = 0,
+) -> Iterator[tuple[str, list[tuple[int, int]]]]:
+    """Serve a directory over HTTP.
+
+    Yields the URL and a list with the client port and bytes sent for each
+    request.
+    """
+    requests: list[tuple[int, int]] = []
+    attributes = {
+        "directory": directory,
+        "ranges": ranges,
+        "errors": errors or [],
+        "requests": requests,
+        "delay": delay,
+    }
+    handler = type("Handler", (_Handler,), attributes)
+    with ThreadingHTTPServer(("127.0.0.1", 0), handler) as server:
+        thread = Thread(target=server.serve_forever, args=(0.01,))
+        thread.start()
+        try:
+            yield f"http://127.0.0.1:{server.server_port}", requests
+        finally:
+            server.shutdown()
+            thread.join()
+
+
 class TestZip(unittest.TestCase):
     """Test the main function when input is a single zip file."""
 
@@ -270,6 +383,402 @@ class TestZip(unittest.TestCase):
                 self.assertEqual(sum(1 for _ in output.iterdir()), 1)
 
 
+class TestRemoteZip(unittest.TestCase):
+    """Test downloading only selected files from a zip file."""
+
+    def _zip(self, directory: Path) -> int:
+        """Write a zip file with a small file and a large ignored file."""
+        with ZipFile(directory / "a.zip", "w", ZIP_STORED) as _zip:
+            _zip.writestr("a", "hello world")
+            _zip.writestr("big", os.urandom(4 * 1024 * 1024))
+        return directory.joinpath("a.zip").stat().st_size
+
+    def test_ranges(self) -> None:
+        """Download less than the whole file if the server supports ranges."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            size = self._zip(source)
+            with _serve(source) as (url, requests):
+                toml = f'[a]\nurl = "{url}/a.zip"\nignore = ["big"]\n'
+                with call(toml, cache, ["--remote-zip"]) as output:
+                    self.assertEqual(output.joinpath("a").read_text(), "hello world")
+                    self.assertEqual(sum(1 for _ in output.iterdir()), 1)
+            self.assertLess(sum(i for _, i in requests), size // 2)
+            self.assertFalse(cache.joinpath("sha256").exists())
+
+    def test_no_ranges(self) -> None:
+        """Download the whole file if the server ignores ranges."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            size = self._zip(source)
+            with _serve(source, ranges=False) as (url, requests):
+                toml = f'[a]\nurl = "{url}/a.zip"\nignore = ["big"]\n'
+                with call(toml, cache, ["--remote-zip"]) as output:
+                    self.assertEqual(output.joinpath("a").read_text(), "hello world")
+            self.assertGreaterEqual(sum(i for _, i in requests), size)
+            self.assertTrue(cache.joinpath("sha256").is_dir())
+
+
+class TestConnections(unittest.TestCase):
+    """Test reusing connections to the same host."""
+
+    def test_reuse(self) -> None:
+        """Download three files, one redirected, over one connection."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            toml = ""
+            for name in "abc":
+                source.joinpath(name).write_text(name)
+            with _serve(source) as (url, requests):
+                toml += f'[a]\nurl = "{url}/a"\n'
+                toml += f'[b]\nurl = "{url}/b"\n'
+                toml += f'[c]\nurl = "{url}/redirect/c"\n'
+                with call(toml, cache) as output:
+                    for name in "abc":
+                        self.assertEqual(output.joinpath(name).read_text(), name)
+            self.assertEqual(len(requests), 4)
+            self.assertEqual(len({port for port, _ in requests}), 1)
+
+    def test_not_found(self) -> None:
+        """Report an error status and exit with a non-zero code."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            with _serve(source) as (url, _):
+                source.joinpath("input.toml").write_text(f'[a]\nurl = "{url}/a"\n')
+                args = [f"--cache={cache}", str(source / "input.toml")]
+                with contextlib.redirect_stdout(StringIO()) as f:
+                    self.assertEqual(main(args), 1)
+            self.assertEqual(f.getvalue(), f"Error 404 downloading {url}/a\n")
+
+
+class TestSharedCache(unittest.TestCase):
+    """Test concurrent runs sharing one cache directory."""
+
+    def test_single_download(self) -> None:
+        """Only one of two concurrent processes downloads the file."""
+        data = os.urandom(4 * 1024 * 1024)
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_bytes(data)
+            with _serve(source) as (url, requests):
+                _input = source / "input.toml"
+                _input.write_text(f'[a]\nurl = "{url}/a"\n')
+                outputs = [source / "1", source / "2"]
+                processes = [
+                    Popen(
+                        [
+                            executable,
+                            Path("src/dotlocalslashbin.py").absolute(),
+                            f"--output={output}",
+                            f"--cache={cache}",
+                            str(_input),
+                        ],
+                        stdout=DEVNULL,
+                    )
+                    for output in outputs
+                ]
+                self.assertEqual([i.wait() for i in processes], [0, 0])
+            for output in outputs:
+                self.assertEqual(output.joinpath("a").read_bytes(), data)
+            self.assertEqual([i for _, i in requests], [len(data)])
+
+
+class TestBundle(unittest.TestCase):
+    """Test filling the cache without installing and moving it between hosts."""
+
+    def test_download_only(self) -> None:
+        """Download into the cache without installing anything."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_text("a")
+            with _serve(source) as (url, _):
+                toml = f'[a]\nurl = "{url}/a"\n'
+                with call(toml, cache, ["--download-only"]) as output:
+                    self.assertEqual(list(output.iterdir()), [])
+            blob = cache / "sha256" / sha256(b"a").hexdigest()
+            self.assertEqual(blob.read_text(), "a")
+
+    def test_export_import(self) -> None:
+        """Install from an imported bundle without using the network."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            for name in "ab":
+                source.joinpath(name).write_text(name)
+            bundle = source / "bundle.tar"
+            with _serve(source) as (url, requests):
+                toml = f'[a]\nurl = "{url}/a"\n[b]\nurl = "{url}/b"\n'
+                with call(toml, cache, [f"--export-bundle={bundle}"]) as output:
+                    self.assertEqual(list(output.iterdir()), [])
+            self.assertEqual(len(requests), 2)
+            with (
+                _directory("cache_") as other,
+                call(toml, other, [f"--import-bundle={bundle}"]) as output,
+            ):
+                for name in "ab":
+                    self.assertEqual(output.joinpath(name).read_text(), name)
+            self.assertEqual(len(requests), 2)
+
+
+class TestStream(unittest.TestCase):
+    """Test installing without keeping downloads."""
+
+    def _serve_tar(self, source: Path) -> bytes:
+        source.joinpath("a").write_text("a")
+        with TarFile.open(source / "a.tar.gz", "w:gz") as tar:
+            tar.add(source / "a", arcname="a")
+        return source.joinpath("a.tar.gz").read_bytes()
+
+    def test_untar(self) -> None:
+        """Extract straight from the response without writing to the cache."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            digest = sha256(self._serve_tar(source)).hexdigest()
+            with _serve(source) as (url, requests):
+                toml = f'[a]\nurl = "{url}/a.tar.gz"\nexpected = "{digest}"\n'
+                with call(toml, cache, ["--no-cache"]) as output:
+                    self.assertEqual(output.joinpath("a").read_text(), "a")
+                    self.assertEqual([i.name for i in output.iterdir()], ["a"])
+            self.assertEqual(list(cache.iterdir()), [])
+            self.assertEqual(len(requests), 1)
+
+    def test_gunzip(self) -> None:
+        """Decompress a single file straight from the response."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            with GzipFile(source / "a.gz", "wb") as file:
+                file.write(b"a")
+            with _serve(source) as (url, _):
+                toml = f'[a]\nurl = "{url}/a.gz"\n'
+                with call(toml, cache, ["--no-cache"]) as output:
+                    self.assertEqual(output.joinpath("a").read_text(), "a")
+
+    def test_unexpected(self) -> None:
+        """Do not install any files if the digest does not match."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            self._serve_tar(source)
+            with _serve(source) as (url, _):
+                toml = f'[a]\nurl = "{url}/a.tar.gz"\nexpected = "{"0" * 64}"\n'
+                source.joinpath("i").write_text(toml)
+                with _directory("output_") as output:
+                    args = [f"--output={output}", f"--cache={cache}", "--no-cache"]
+                    with (
+                        self.assertRaisesRegex(RuntimeError, "Unexpected digest"),
+                        contextlib.redirect_stdout(StringIO()),
+                    ):
+                        main([*args, str(source / "i")])
+                    self.assertEqual(list(output.iterdir()), [])
+
+    def test_unexpected_installed(self) -> None:
+        """Keep an installed target if the digest does not match."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            digest = sha256(self._serve_tar(source)).hexdigest()
+            with _serve(source) as (url, _), _directory("output_") as output:
+                args = [f"--output={output}", f"--cache={cache}", "--no-cache"]
+                toml = f'[a]\nurl = "{url}/a.tar.gz"\nexpected = "{digest}"\n'
+                source.joinpath("i").write_text(toml)
+                with contextlib.redirect_stdout(StringIO()):
+                    main([*args, str(source / "i")])
+                source.joinpath("i").write_text(toml.replace(digest, "0" * 64))
+                with (
+                    self.assertRaisesRegex(RuntimeError, f"for {url}/a.tar.gz"),
+                    contextlib.redirect_stdout(StringIO()),
+                ):
+                    main([*args, str(source / "i")])
+                self.assertEqual(output.joinpath("a").read_text(), "a")
+
+
+class TestDecompress(unittest.TestCase):
+    """Test decompressing single files."""
+
+    def test_extension(self) -> None:
+        """Guess the action from the extension, reading every gzip member."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a.xz").write_bytes(lzma.compress(b"a"))
+            source.joinpath("b.bz2").write_bytes(bz2.compress(b"b"))
+            for data in (b"c", b"c"):
+                with GzipFile(source / "c.gz", "ab") as file:
+                    file.write(data)
+            with _serve(source) as (url, _):
+                toml = f'[a]\nurl = "{url}/a.xz"\n'
+                toml += f'[b]\nurl = "{url}/b.bz2"\n'
+                toml += f'[c]\nurl = "{url}/c.gz"\n'
+                with call(toml, cache) as output:
+                    self.assertEqual(output.joinpath("a").read_text(), "a")
+                    self.assertEqual(output.joinpath("b").read_text(), "b")
+                    self.assertEqual(output.joinpath("c").read_text(), "cc")
+                    self.assertEqual(len(list(output.iterdir())), 3)
+
+    def test_stream(self) -> None:
+        """Decompress xz straight from the response."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a.xz").write_bytes(lzma.compress(b"a"))
+            with _serve(source) as (url, _):
+                toml = f'[a]\nurl = "{url}/a.xz"\n'
+                with call(toml, cache, ["--no-cache"]) as output:
+                    self.assertEqual(output.joinpath("a").read_text(), "a")
+
+    def test_magic(self) -> None:
+        """Detect compression without an extension from the first bytes."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            source.joinpath("a").write_bytes(bz2.compress(b"a"))
+            with _serve(source) as (url, _):
+                specs = {"a": {"url": f"{url}/a"}}
+                args = [f"--output={output}", f"--cache={cache}"]
+                (first,) = install(specs, args)
+                self.assertEqual(output.joinpath("a").read_text(), "a")
+                (second,) = install(specs, args)
+                source.joinpath("input.toml").write_text(f'[a]\nurl = "{url}/a"\n')
+                with contextlib.redirect_stdout(StringIO()) as stdout:
+                    returncode = main(["--check", *args, str(source / "input.toml")])
+        self.assertEqual(first.status, "downloaded")
+        self.assertEqual(second.status, "current")
+        self.assertEqual(returncode, 0)
+        self.assertIn("up to date: a", stdout.getvalue())
+
+
+class TestResume(unittest.TestCase):
+    """Test resuming interrupted downloads."""
+
+    def _resume(self, data: bytes, part: bytes, validator: str | None) -> int:
+        """Download data after writing part, returning the bytes sent."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_bytes(data)
+            with _serve(source) as (url, requests):
+                partial = _Cache(cache).partial(f"{url}/a")
+                partial.parent.mkdir()
+                partial.write_bytes(part)
+                if validator is not None:
+                    header = {"If-Range": validator}
+                    partial.with_suffix(".json").write_text(json.dumps(header))
+                toml = f'[a]\nurl = "{url}/a"\n'
+                with call(toml, cache) as output:
+                    self.assertEqual(output.joinpath("a").read_bytes(), data)
+            self.assertEqual(list(partial.parent.iterdir()), [])
+            return sum(i for _, i in requests)
+
+    def test_if_range(self) -> None:
+        """Only download the rest of the file if the validator matches."""
+        data = os.urandom(1024)
+        etag = f'"{sha256(data).hexdigest()}"'
+        self.assertEqual(self._resume(data, data[:1000], etag), 24)
+
+    def test_changed(self) -> None:
+        """Download the whole file if it has changed."""
+        data = os.urandom(1024)
+        self.assertEqual(self._resume(data, data[:1000], '"changed"'), 1024)
+
+    def test_no_validator(self) -> None:
+        """Download the whole file without a validator or expected digest."""
+        data = os.urandom(1024)
+        self.assertEqual(self._resume(data, data[:1000], None), 1024)
+
+    def test_complete(self) -> None:
+        """Download again if the partial file is already the full size."""
+        data = os.urandom(1024)
+        etag = f'"{sha256(data).hexdigest()}"'
+        self.assertEqual(self._resume(data, data, etag), 1024)
+
+    def test_shrunk(self) -> None:
+        """Download again if the file is now shorter than the partial file."""
+        data = os.urandom(1024)
+        etag = f'"{sha256(data).hexdigest()}"'
+        self.assertEqual(self._resume(data, data + data, etag), 1024)
+
+    def test_expected(self) -> None:
+        """Resume using a range without a validator if there is a digest."""
+        data = os.urandom(1024)
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_bytes(data)
+            with _serve(source) as (url, requests):
+                partial = _Cache(cache).partial(f"{url}/a")
+                partial.parent.mkdir()
+                partial.write_bytes(b"corrupt")
+                toml = f'[a]\nurl = "{url}/a"\n'
+                toml += f'expected = "{sha256(data).hexdigest()}"\n'
+                with (
+                    self.assertRaisesRegex(RuntimeError, "Unexpected digest"),
+                    call(toml, cache),
+                ):
+                    pass
+                self.assertFalse(partial.exists())
+                with call(toml, cache) as output:
+                    self.assertEqual(output.joinpath("a").read_bytes(), data)
+            self.assertEqual([i for _, i in requests], [1024 - 7, 1024])
+
+
+class TestReport(unittest.TestCase):
+    """Test the machine-readable report of a run."""
+
+    def test_statuses(self) -> None:
+        """Report bytes transferred, cache hits and timings for each phase."""
+        data = os.urandom(1024)
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_bytes(data)
+            _write_zip(source / "a.zip", [source / "a"])
+            source.joinpath("b").write_bytes(data)
+            report = source / "run.json"
+            with _serve(source) as (url, _):
+                toml = f'[a]\nurl = "{url}/a.zip"\n[b]\nurl = "{url}/b"\n'
+                with call(toml, cache, [f"--report={report}"]):
+                    first = json.loads(report.read_text())
+                with call(toml, cache, [f"--report={report}"]):
+                    second = json.loads(report.read_text())
+        a, b = first["items"]
+        self.assertEqual((a["status"], b["status"]), ("downloaded", "downloaded"))
+        self.assertEqual(b["bytes_transferred"], 1024)
+        self.assertFalse(b["cache_hit"])
+        self.assertIn("download", b["timings"])
+        self.assertIn("decompression_bytes_per_second", a)
+        a, b = second["items"]
+        self.assertEqual((a["status"], b["status"]), ("cached", "cached"))
+        self.assertEqual(b["bytes_transferred"], 0)
+        self.assertTrue(b["cache_hit"])
+        self.assertNotIn("download", b["timings"])
+
+    def test_profile(self) -> None:
+        """Print the timings for each item to standard error."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_text("a")
+            toml = f'[a]\nurl = "{source}/a"\n'
+            with (
+                contextlib.redirect_stderr(StringIO()) as stderr,
+                call(toml, cache, ["--profile"]),
+            ):
+                pass
+        self.assertRegex(stderr.getvalue(), r"^a: local 0B .*total=")
+
+
+class TestRetry(unittest.TestCase):
+    """Test retrying transient errors."""
+
+    def _run(self, errors: list[int], toml: str, extra: list[str]) -> tuple[int, int]:
+        """Return the exit code and number of requests."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            source.joinpath("a").write_text("hello world")
+            with _serve(source, errors=errors) as (url, requests):
+                _input = source / "input.toml"
+                _input.write_text(f'[a]\nurl = "{url}/a"\n{toml}')
+                args = [f"--output={output}", f"--cache={cache}", "--retry-delay=0"]
+                with contextlib.redirect_stdout(StringIO()):
+                    code = main([*args, *extra, str(_input)])
+            return code, len(requests)
+
+    def test_transient(self) -> None:
+        """Retry server errors and too many requests."""
+        self.assertEqual(self._run([503, 429], "", []), (0, 3))
+
+    def test_too_many(self) -> None:
+        """Give up after the number of retries."""
+        self.assertEqual(self._run([502] * 3, "", ["--retries=1"]), (1, 2))
+
+    def test_item(self) -> None:
+        """Allow an item to override the number of retries."""
+        self.assertEqual(self._run([500], "retries = 0\n", []), (1, 1))
+
+    def test_client_error(self) -> None:
+        """Do not retry client errors."""
+        self.assertEqual(self._run([403], "", []), (1, 1))
+
+
 class TestTar(unittest.TestCase):
     """Test the main function when input is a single tar.gz file."""
 
@@ -305,6 +814,811 @@ class TestTar(unittest.TestCase):
             with call(toml, cache) as output:
                 self.assertEqual(sum(1 for _ in output.iterdir()), 0)
 
+    def test_xz_prefix_and_ignore(self) -> None:
+        """Process a tar.xz with a prefix, an ignored file and a directory."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            for name in ("a", "ignored", "c/d"):
+                source.joinpath("b", name).parent.mkdir(parents=True, exist_ok=True)
+                source.joinpath("b", name).write_text(name)
+
+            with TarFile.open(cache / "a.tar.xz", "w:xz") as tar:
+                tar.add(source / "b", arcname="b")
+
+            toml = '[a]\nurl = "https://example.com/a.tar.xz"\n'
+            toml += 'prefix = "b"\nignore = ["ignored"]\n'
+
+            with call(toml, cache) as output:
+                self.assertEqual(output.joinpath("a").read_text(), "a")
+                self.assertEqual(output.joinpath("c", "d").read_text(), "c/d")
+                self.assertFalse(output.joinpath("ignored").exists())
+
+
+class TestTrees(unittest.TestCase):
+    """Test reusing archives unpacked into the cache."""
+
+    def _install(self, cache: Path, output: Path, extra: list[str]) -> None:
+        toml = cache / "input.toml"
+        digest = sha256(cache.joinpath("a.tar.gz").read_bytes()).hexdigest()
+        toml.write_text(
+            f'[a]\nurl = "https://example.com/a.tar.gz"\nexpected = "{digest}"\n',
+        )
+        args = [f"--output={output}", f"--cache={cache}", *extra, str(toml)]
+        with contextlib.redirect_stdout(StringIO()):
+            main(args)
+
+    def test_restore(self) -> None:
+        """Restore a deleted file from the tree without decompressing again."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            source.joinpath("a").write_text("a")
+            with TarFile.open(cache / "a.tar.gz", "w:gz") as tar:
+                tar.add(source / "a", arcname="a")
+            self._install(cache, output, [])
+            output.joinpath("a").unlink()
+
+            with patch("tarfile.open", wraps=tar_open) as opened:
+                self._install(cache, output, [])
+            self.assertEqual(opened.call_count, 0)
+            self.assertEqual(output.joinpath("a").read_text(), "a")
+            (tree,) = cache.joinpath("trees").iterdir()
+            self.assertFalse(output.joinpath("a").samefile(tree / "a"))
+
+    def test_sha512(self) -> None:
+        """Name the tree without reading a fresh download again."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_text("a")
+            with TarFile.open(source / "a.tar.gz", "w:gz") as tar:
+                tar.add(source / "a", arcname="a")
+            data = source.joinpath("a.tar.gz").read_bytes()
+            with (
+                _serve(source) as (url, _),
+                patch("dotlocalslashbin._hash", wraps=_hash) as hashed,
+            ):
+                toml = f'[a]\nurl = "{url}/a.tar.gz"\n'
+                toml += f'expected = "{sha512(data).hexdigest()}"\n'
+                with call(toml, cache) as output:
+                    self.assertEqual(output.joinpath("a").read_text(), "a")
+            self.assertEqual(hashed.call_count, 0)
+
+    def test_evict(self) -> None:
+        """Count trees towards the size of the cache, unless they are in use."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            source.joinpath("a").write_text("a")
+            with TarFile.open(cache / "a.tar.gz", "w:gz") as tar:
+                tar.add(source / "a", arcname="a")
+            self._install(cache, output, [])
+
+            self._install(cache, output, ["--gc", "--cache-max-size=0"])
+            self.assertEqual(len(list(cache.joinpath("trees").iterdir())), 1)
+
+            (toml := source / "input.toml").write_text("")
+            with contextlib.redirect_stdout(StringIO()):
+                main([f"--cache={cache}", "--gc", "--cache-max-size=0", str(toml)])
+            self.assertEqual(list(cache.joinpath("trees").iterdir()), [])
+
+    def test_access(self) -> None:
+        """Only record access to a tree when it is used."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            source.joinpath("a").write_text("a")
+            with TarFile.open(cache / "a.tar.gz", "w:gz") as tar:
+                tar.add(source / "a", arcname="a")
+            self._install(cache, output, ["--gc"])
+            self.assertEqual(json.loads(cache.joinpath("access.json").read_text()), {})
+
+            self._install(cache, output, [])
+            (tree,) = cache.joinpath("trees").iterdir()
+            access = json.loads(cache.joinpath("access.json").read_text())
+            self.assertIn(tree.name, access)
+
+
+class TestMembers(unittest.TestCase):
+    """Test memory use while extracting from tar files."""
+
+    def test_members(self) -> None:
+        """Do not keep every member of a tar file in memory."""
+        counts = []
+        extract = TarFile.extract
+
+        def _extract(file: TarFile, member: TarInfo, path: Path, **_: str) -> None:
+            counts.append(len(vars(file)["members"]))
+            extract(file, member, path, filter="tar")
+
+        with _directory("source_") as source, _directory("cache_") as cache:
+            with TarFile.open(cache / "a.tar.gz", "w:gz") as tar:
+                for name in "abc":
+                    source.joinpath(name).write_text(name)
+                    tar.add(source / name, arcname=f"a/{name}")
+            toml = '[a]\nurl = "https://example.com/a.tar.gz"\nprefix = "a/"\n'
+            with (
+                patch.object(TarFile, "extract", autospec=True, side_effect=_extract),
+                call(toml, cache) as output,
+            ):
+                self.assertEqual(output.joinpath("c").read_text(), "c")
+        self.assertEqual(len(counts), 3)
+        self.assertEqual(max(counts), 0)
+
+
+class TestGroup(unittest.TestCase):
+    """Test items extracted from the same archive."""
+
+    def test_one_pass(self) -> None:
+        """Extract files for three items in a single pass over the archive."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            for name in "ab":
+                source.joinpath(name).mkdir()
+                source.joinpath(name, name).write_text(name)
+            with TarFile.open(cache / "a.tar.gz", "w:gz") as tar:
+                tar.add(source / "a", arcname="a")
+                tar.add(source / "b", arcname="b")
+            url = "https://example.com/a.tar.gz"
+            toml = f'[a]\nurl = "{url}"\nprefix = "a/"\n'
+            toml += f'[b]\nurl = "{url}"\nprefix = "b/"\n'
+            toml += f'[all]\nurl = "{url}"\ntarget = "{source}/all/a"\n'
+            with (
+                patch("tarfile.open", wraps=tar_open) as opened,
+                call(toml, cache) as output,
+            ):
+                self.assertEqual(output.joinpath("a").read_text(), "a")
+                self.assertEqual(output.joinpath("b").read_text(), "b")
+            self.assertEqual(source.joinpath("all", "a", "a").read_text(), "a")
+            self.assertEqual(source.joinpath("all", "b", "b").read_text(), "b")
+            self.assertEqual(opened.call_count, 1)
+
+
+class TestJobs(unittest.TestCase):
+    """Test processing items in parallel."""
+
+    def test_order(self) -> None:
+        """Display the results in input order."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            toml = ""
+            for name in "edcba":
+                path = source / name
+                path.write_text(name)
+                _write_zip(cache / f"{name}.zip", [path])
+                toml += f'[{name}]\nurl = "https://example.com/{name}.zip"\n'
+
+            with _directory("output_") as output:
+                _input = output / "input.toml"
+                _input.write_text(toml)
+                args = [f"--output={output}", f"--cache={cache}", "--jobs=3"]
+                with contextlib.redirect_stdout(StringIO()) as f:
+                    main([*args, str(_input)])
+                lines = [i for i in f.getvalue().splitlines() if i]
+                names = [Path(i.split()[1]).name for i in lines]
+                self.assertEqual(names, list("edcba"))
+                for name in "edcba":
+                    self.assertEqual(output.joinpath(name).read_text(), name)
+
+    def test_archives(self) -> None:
+        """Extract several kinds of archive in parallel."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            (a := source / "a").write_text("hello world")
+            _write_zip(cache / "a.zip", [a])
+            with TarFile.open(cache / "a.tar.xz", "w:xz") as tar:
+                tar.add(a, arcname="b/a")
+            with GzipFile(cache / "c.gz", "w") as gzip:
+                gzip.write(b"hello world")
+
+            toml = '[a]\nurl = "https://example.com/a.zip"\n'
+            toml += '[b]\nurl = "https://example.com/a.tar.xz"\n'
+            toml += '[c]\nurl = "https://example.com/c.gz"\n'
+
+            with call(toml, cache, ["--jobs=3"]) as output:
+                for path in ("a", "b/a", "c"):
+                    self.assertEqual(output.joinpath(path).read_text(), "hello world")
+
+    def test_pool_and_locks(self) -> None:
+        """Finish when the pool starts while another thread holds a lock."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            (a := source / "a").write_text("a")
+            with TarFile.open(source / "b.tar.gz", "w:gz") as tar:
+                tar.add(a, arcname="b")
+            with _serve(source, delay=1) as (url, _), _directory("output_") as output:
+                toml = f'[a]\nurl = "{url}/a"\n'
+                toml += f'[c]\nurl = "{url}/a"\ntarget = "{output}/c"\n'
+                toml += f'[b]\nurl = "{source}/b.tar.gz"\naction = "untar"\n'
+                _input = source / "input.toml"
+                _input.write_text(toml)
+                run(
+                    [
+                        executable,
+                        Path("src/dotlocalslashbin.py").absolute(),
+                        f"--output={output}",
+                        f"--cache={cache}",
+                        "--jobs=3",
+                        str(_input),
+                    ],
+                    check=True,
+                    capture_output=True,
+                    timeout=30,
+                )
+                self.assertEqual(output.joinpath("c").read_text(), "a")
+
+    def test_first_failure(self) -> None:
+        """Raise the error from the first failing item in input order."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            toml = ""
+            for name in "ab":
+                path = source / name
+                path.write_text(name)
+                _write_zip(cache / f"{name}.zip", [path])
+                toml += f'[{name}]\nurl = "https://example.com/{name}.zip"\n'
+                toml += f'expected = "{"0" * 64}"\n'
+
+            with (
+                self.assertRaisesRegex(RuntimeError, "a.zip"),
+                call(toml, cache, ["--jobs=2"]),
+            ):
+                pass
+
+
+class TestManifest(unittest.TestCase):
+    """Test skipping items that are already installed."""
+
+    def _run(self, source: Path, cache: Path, output: Path) -> None:
+        _input = source / "input.toml"
+        _input.write_text('[a]\nurl = "https://example.com/a.zip"\n')
+        args = [f"--output={output}", f"--cache={cache}", str(_input)]
+        with contextlib.redirect_stdout(StringIO()):
+            main(args)
+
+    def test_unchanged(self) -> None:
+        """Do not extract again if nothing has changed."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            (a := source / "a").write_text("hello world")
+            _write_zip(cache / "a.zip", [a])
+
+            self._run(source, cache, output)
+            before = output.joinpath("a").stat().st_ino
+            self._run(source, cache, output)
+            self.assertEqual(output.joinpath("a").stat().st_ino, before)
+
+    def test_output_changed(self) -> None:
+        """Extract again if an output was modified."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            (a := source / "a").write_text("hello world")
+            _write_zip(cache / "a.zip", [a])
+
+            self._run(source, cache, output)
+            output.joinpath("a").write_text("modified")
+            self._run(source, cache, output)
+            self.assertEqual(output.joinpath("a").read_text(), "hello world")
+
+    def test_input_changed(self) -> None:
+        """Extract again if the downloaded file was replaced."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            (a := source / "a").write_text("hello world")
+            _write_zip(cache / "a.zip", [a])
+
+            self._run(source, cache, output)
+            a.write_text("goodbye")
+            _write_zip(cache / "a.zip", [a])
+            self._run(source, cache, output)
+            self.assertEqual(output.joinpath("a").read_text(), "goodbye")
+
+    def test_shared_output(self) -> None:
+        """Skip items that both install a file once each has been installed."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            specs: dict[str, dict[str, str]] = {}
+            for name in ("a", "b"):
+                source.joinpath(name).write_text(name)
+                (license_ := source / "LICENSE").write_text(f"license for {name}")
+                os.utime(license_, (0, len(specs)))
+                with TarFile.open(archive := source / f"{name}.tar", "w") as tar:
+                    tar.add(source / name, arcname=name)
+                    tar.add(license_, arcname="LICENSE")
+                specs[name] = {"url": str(archive), "action": "untar"}
+            args = [f"--output={output}", f"--cache={cache}"]
+
+            install(specs, args)
+            results = install(specs, args)
+            self.assertEqual([i.status for i in results], ["current", "current"])
+            self.assertNotIn(output / "LICENSE", results[0].outputs)
+            self.assertIn(output / "LICENSE", results[1].outputs)
+
+            _input = source / "input.toml"
+            toml = "".join(
+                f'[{k}]\nurl = "{v["url"]}"\naction = "untar"\n'
+                for k, v in specs.items()
+            )
+            _input.write_text(toml)
+            with contextlib.redirect_stdout(StringIO()):
+                self.assertEqual(main(["--check", *args, str(_input)]), 0)
+
+
+class TestForget(unittest.TestCase):
+    """Test removing entries from the manifest."""
+
+    def test_failure(self) -> None:
+        """Forget an item in the manifest if installing it again fails."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            source.joinpath("a").write_text("a")
+            with TarFile.open(archive := source / "a.tar.gz", "w:gz") as tar:
+                tar.add(source / "a", arcname="a")
+            _input = source / "input.toml"
+            _input.write_text(f'[a]\nurl = "{archive}"\naction = "untar"\n')
+            args = [f"--output={output}", f"--cache={cache}", str(_input)]
+            with contextlib.redirect_stdout(StringIO()):
+                main(args)
+            manifest = cache / "manifest.json"
+            self.assertEqual(len(json.loads(manifest.read_text())), 1)
+            archive.write_bytes(b"corrupt")
+            with (
+                self.assertRaises(ReadError),
+                contextlib.redirect_stdout(StringIO()),
+            ):
+                main(args)
+            self.assertEqual(json.loads(manifest.read_text()), {})
+
+
+class TestCheck(unittest.TestCase):
+    """Test reporting which items need installing without installing them."""
+
+    def _check(self, source: Path, cache: Path, output: Path) -> tuple[int, str]:
+        _input = source / "input.toml"
+        toml = '[a]\nurl = "https://example.com/a.zip"\n'
+        toml += '[b]\nurl = "https://example.com/b.zip"\n'
+        _input.write_text(toml)
+        args = ["--check", f"--output={output}", f"--cache={cache}", str(_input)]
+        with contextlib.redirect_stdout(StringIO()) as stdout:
+            returncode = main(args)
+        return returncode, stdout.getvalue()
+
+    def test_states(self) -> None:
+        """Report missing, stale and up to date items without changing files."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            (a := source / "a").write_text("hello world")
+            _write_zip(cache / "a.zip", [a])
+            toml = source / "a.toml"
+            toml.write_text('[a]\nurl = "https://example.com/a.zip"\n')
+            with contextlib.redirect_stdout(StringIO()):
+                main([f"--output={output}", f"--cache={cache}", str(toml)])
+            before = sorted(cache.rglob("*"))
+
+            returncode, stdout = self._check(source, cache, output)
+            self.assertEqual(returncode, 1)
+            self.assertIn("up to date: a", stdout)
+            self.assertIn("missing: b", stdout)
+
+            output.joinpath("a").write_text("modified")
+            _, stdout = self._check(source, cache, output)
+            self.assertIn("stale: a", stdout)
+            self.assertEqual(sorted(cache.rglob("*")), before)
+
+    def test_startup(self) -> None:
+        """Check without importing modules only needed to install."""
+        heavy = [
+            "concurrent.futures.process",
+            "email.utils",
+            "gzip",
+            "hashlib",
+            "http.client",
+            "subprocess",
+            "tarfile",
+            "urllib.request",
+            "zipfile",
+        ]
+        with _directory("cache_") as cache, _directory("source_") as source:
+            _input = source / "input.toml"
+            _input.write_text('[a]\nurl = "https://example.com/a.zip"\n')
+            code = (
+                "import sys; from dotlocalslashbin import main;"
+                f"main(['--check', '--cache={cache}', '{_input}']);"
+                f"print([i for i in {heavy} if i in sys.modules])"
+            )
+            env = os.environ | {"PYTHONPATH": str(Path(__file__).parent)}
+            completed = run(
+                [executable, "-c", code],
+                capture_output=True,
+                check=True,
+                env=env,
+                text=True,
+            )
+        self.assertEqual(completed.stdout.splitlines()[-1], "[]")
+
+
+class TestSelect(unittest.TestCase):
+    """Test processing only some items by name or tag."""
+
+    def _select(self, extra: list[str]) -> set[str]:
+        with _directory("source_") as source, _directory("cache_") as cache:
+            toml = ""
+            for name, tags in (("a", '["x"]'), ("b", '["y"]'), ("c", "[]")):
+                source.joinpath(name).write_text(name)
+                toml += f'[{name}]\nurl = "{source / name}"\ntags = {tags}\n'
+            # never downloaded unless selected, so would fail without a network
+            toml += '[d]\nurl = "https://example.invalid/d"\ntags = ["y"]\n'
+            with call(toml, cache, extra) as output:
+                return {i.name for i in output.iterdir()}
+
+    def test_only(self) -> None:
+        """Only process items with a matching name."""
+        self.assertEqual(self._select(["--only=a", "--only=[bc]"]), {"a", "b", "c"})
+        self.assertEqual(self._select(["--only=a"]), {"a"})
+
+    def test_tag(self) -> None:
+        """Match tags as well as names."""
+        self.assertEqual(self._select(["--only=x"]), {"a"})
+
+    def test_exclude(self) -> None:
+        """Skip items with a matching name or tag."""
+        self.assertEqual(self._select(["--exclude=y"]), {"a", "c"})
+        self.assertEqual(self._select(["--only=?", "--exclude=[dc]"]), {"a", "b"})
+
+
+class TestLibrary(unittest.TestCase):
+    """Test installing from Python instead of the command line."""
+
+    def test_results(self) -> None:
+        """Return a result for each item, recording errors, without printing."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            (a := source / "a").write_text("hello world")
+            _write_zip(cache / "a.zip", [a])
+            specs = {
+                "a": {"url": "https://example.com/a.zip"},
+                "b": {"url": str(a), "expected": "0" * 64},
+            }
+            with (
+                _directory("output_") as output,
+                contextlib.redirect_stdout(StringIO()) as stdout,
+            ):
+                results = install(specs, [f"--output={output}", f"--cache={cache}"])
+                self.assertEqual(output.joinpath("a").read_text(), "hello world")
+
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertEqual([i.name for i in results], ["a", "b"])
+        self.assertEqual(results[0].status, "cached")
+        self.assertEqual(results[0].outputs, (output / "a",))
+        self.assertIsNone(results[0].error)
+        self.assertIn("total", results[0].timings)
+        self.assertEqual(results[1].status, "failed")
+        self.assertIsNotNone(results[1].error)
+
+    def test_quiet(self) -> None:
+        """Print nothing while downloading or retrying."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            source.joinpath("a").write_text("a")
+            with (
+                _serve(source, errors=[503]) as (url, _),
+                _directory("output_") as output,
+                contextlib.redirect_stdout(StringIO()) as stdout,
+            ):
+                specs = {"a": {"url": f"{url}/a", "retry_delay": 0}}
+                (result,) = install(specs, [f"--output={output}", f"--cache={cache}"])
+        self.assertEqual(result.status, "downloaded")
+        self.assertEqual(stdout.getvalue(), "")
+
+    def test_async(self) -> None:
+        """Install concurrently with a shared cache."""
+
+        async def _install(cache: Path, outputs: list[Path]) -> list[list]:
+            specs = {"a": {"url": "https://example.com/a.zip"}}
+            calls = [
+                install_async(specs, [f"--output={i}", f"--cache={cache}"])
+                for i in outputs
+            ]
+            return await asyncio.gather(*calls)
+
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            (a := source / "a").write_text("hello world")
+            _write_zip(cache / "a.zip", [a])
+            outputs = [output / "1", output / "2"]
+            results = asyncio.run(_install(cache, outputs))
+            for i, (result,) in zip(outputs, results, strict=True):
+                self.assertIsNone(result.error)
+                self.assertEqual(i.joinpath("a").read_text(), "hello world")
+
+
+class TestVersion(unittest.TestCase):
+    """Test caching the output of version checks."""
+
+    def test_unchanged(self) -> None:
+        """Only run the version check again if the target changes."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            log = source / "log"
+            script = source / "a"
+            script.write_text(f"#!/bin/sh\necho run >> {log}\necho 1.0\n")
+            toml = f'[a]\nurl = "{script}"\naction = "copy"\nversion = "--version"\n'
+            with _directory("output_") as output:
+                args = [f"--output={output}", f"--cache={cache}", str(source / "i")]
+                source.joinpath("i").write_text(toml)
+                for _ in range(2):
+                    with contextlib.redirect_stdout(StringIO()) as stdout:
+                        main(args)
+                    self.assertIn("1.0\n", stdout.getvalue())
+                self.assertEqual(log.read_text(), "run\n")
+                output.joinpath("a").touch()
+                with contextlib.redirect_stdout(StringIO()):
+                    main(args)
+            self.assertEqual(log.read_text(), "run\nrun\n")
+
+
+class TestVerify(unittest.TestCase):
+    """Test that unchanged files are not hashed again."""
+
+    def test_reverify(self) -> None:
+        """Only notice a change that preserves size and mtime with --reverify."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            (a := cache / "a").write_text("hello")
+            _input = source / "input.toml"
+            toml = '[a]\nurl = "https://example.com/a"\n'
+            toml += f'expected = "{sha256(b"hello").hexdigest()}"\n'
+            _input.write_text(toml)
+            args = [f"--output={output}", f"--cache={cache}", str(_input)]
+            with contextlib.redirect_stdout(StringIO()):
+                main(args)
+
+                stat = a.stat()
+                a.write_text("jello")
+                os.utime(a, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+                output.joinpath("a").unlink()
+                main(args)
+                self.assertEqual(output.joinpath("a").read_text(), "jello")
+
+                with self.assertRaisesRegex(RuntimeError, "Unexpected digest"):
+                    main(["--reverify", *args])
+
+    def test_prune(self) -> None:
+        """Forget the digests of files that were changed or removed."""
+        with (
+            _directory("source_") as source,
+            _directory("cache_") as cache,
+            _directory("output_") as output,
+        ):
+            _input = source / "input.toml"
+            _input.write_text(f'[a]\nurl = "{source / "a"}"\nexpected = "{"0" * 64}"\n')
+            args = [f"--output={output}", f"--cache={cache}", str(_input)]
+            for content in ("a", "b"):
+                source.joinpath("a").unlink(missing_ok=True)
+                source.joinpath("a").write_text(content)
+                with (
+                    self.assertRaisesRegex(RuntimeError, "Unexpected digest"),
+                    contextlib.redirect_stdout(StringIO()),
+                ):
+                    main(args)
+                digests = json.loads(cache.joinpath("digests.json").read_text())
+                self.assertEqual(len(digests), 1)
+            source.joinpath("a").unlink()
+            with (
+                contextlib.suppress(FileNotFoundError),
+                contextlib.redirect_stdout(StringIO()),
+            ):
+                main(args)
+            self.assertEqual(json.loads(cache.joinpath("digests.json").read_text()), {})
+
+
+class TestLinkMode(unittest.TestCase):
+    """Test installing by linking from the cache."""
+
+    def test_copy_hardlink(self) -> None:
+        """Hard link a copied file to the download in the cache."""
+        with _directory("cache_") as cache:
+            cache.joinpath("a").write_text("hello world")
+            toml = '[a]\nurl = "https://example.com/a"\n'
+
+            with call(toml, cache, ["--link-mode=hardlink"]) as output:
+                self.assertTrue(output.joinpath("a").samefile(cache / "a"))
+
+    def test_copy(self) -> None:
+        """Copy a file by default."""
+        with _directory("cache_") as cache:
+            cache.joinpath("a").write_text("hello world")
+            toml = '[a]\nurl = "https://example.com/a"\n'
+
+            with call(toml, cache) as output:
+                self.assertFalse(output.joinpath("a").samefile(cache / "a"))
+                self.assertEqual(output.joinpath("a").read_text(), "hello world")
+
+    def test_unzip_hardlink(self) -> None:
+        """Hard link extracted files to an unpacked tree in the cache."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            (b := source / "b").mkdir()
+            b.joinpath("a").write_text("hello world")
+            b.joinpath("c").write_text("hello world")
+            _write_zip(cache / "a.zip", [b / "a", b / "c"], source)
+            toml = '[a]\nurl = "https://example.com/a.zip"\nprefix = "b"\n'
+
+            with call(toml, cache, ["--link-mode=hardlink"]) as output:
+                self.assertEqual(output.joinpath("a").read_text(), "hello world")
+                self.assertEqual(output.joinpath("a").stat().st_nlink, 2)
+                self.assertEqual(output.joinpath("c").stat().st_nlink, 2)
+                (tree,) = cache.joinpath("trees").iterdir()
+                self.assertTrue(output.joinpath("a").samefile(tree / "a"))
+
+    def test_auto(self) -> None:
+        """Install the contents of a gzip file with the auto mode."""
+        with _directory("cache_") as cache:
+            with GzipFile(cache / "a.gz", "w") as gzip:
+                gzip.write(b"hello world")
+            toml = '[a]\nurl = "https://example.com/a.gz"\n'
+
+            with call(toml, cache, ["--link-mode=auto"]) as output:
+                self.assertEqual(output.joinpath("a").read_text(), "hello world")
+
+
+class TestDownload(unittest.TestCase):
+    """Test streaming downloads into the cache."""
+
+    def _item(self, source: Path, cache: Path, expected: str | None) -> Item:
+        item = Item()
+        item.name = "a"
+        item.url = source.as_uri()
+        item.downloaded = cache / "a"
+        item.expected = expected
+        return item
+
+    def test_expected(self) -> None:
+        """Move a download with the expected digest into the cache."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            (a := source / "a").write_bytes(b"hello world")
+            expected = sha256(b"hello world").hexdigest()
+            item = self._item(a, cache, expected)
+            with contextlib.redirect_stdout(StringIO()):
+                _download(item, _Cache(cache), _Context())
+            self.assertEqual(item.downloaded, cache / "sha256" / expected)
+            self.assertEqual(list(cache.joinpath("partial").iterdir()), [])
+
+    def test_unexpected(self) -> None:
+        """Leave nothing in the cache when the digest is wrong."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            (a := source / "a").write_bytes(b"hello world")
+            with (
+                contextlib.redirect_stdout(StringIO()),
+                self.assertRaisesRegex(RuntimeError, "Unexpected digest"),
+            ):
+                _download(self._item(a, cache, "0" * 64), _Cache(cache), _Context())
+            self.assertFalse(cache.joinpath("sha256").exists())
+            self.assertEqual(list(cache.joinpath("partial").iterdir()), [])
+
+
+class TestContentAddressed(unittest.TestCase):
+    """Test that downloads are stored by digest."""
+
+    def _download(self, sources: list[Path], cache: Path) -> _Cache:
+        _cache = _Cache(cache)
+        for source in sources:
+            item = Item()
+            item.name = source.name
+            item.url = source.as_uri()
+            item.expected = None
+            with contextlib.redirect_stdout(StringIO()):
+                _download(item, _cache, _Context())
+        _cache.save()
+        return _Cache(cache)
+
+    def test_same_name(self) -> None:
+        """Keep different files from URLs with the same last part."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            for i in "bc":
+                source.joinpath(i).mkdir()
+                source.joinpath(i, "a").write_text(i)
+            sources = [source / "b" / "a", source / "c" / "a"]
+
+            index = self._download(sources, cache).index
+
+            self.assertEqual(len(set(index.values())), 2)
+            for path in sources:
+                blob = cache / "sha256" / index[path.as_uri()]
+                self.assertEqual(blob.read_text(), path.read_text())
+
+    def test_same_content(self) -> None:
+        """Store the same content from two URLs once."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            for i in "ab":
+                source.joinpath(i).write_text("hello world")
+
+            index = self._download([source / "a", source / "b"], cache).index
+
+            self.assertEqual(len(index), 2)
+            self.assertEqual(sum(1 for _ in cache.joinpath("sha256").iterdir()), 1)
+
+
+class TestEvict(unittest.TestCase):
+    """Test evicting least recently used downloads from the cache."""
+
+    def _gc(self, source: Path, cache: Path, extra: list[str]) -> set[str]:
+        """Populate the cache with a, b and c then run --gc.
+
+        The access times are in that order and a is referenced by the input.
+        """
+        _cache = _Cache(cache)
+        for i, name in enumerate("abc"):
+            source.joinpath(name).write_text(name)
+            item = Item()
+            item.name = name
+            item.url = source.joinpath(name).as_uri()
+            item.expected = None
+            with contextlib.redirect_stdout(StringIO()), _cache.lock(item.url):
+                _download(item, _cache, _Context())
+            _cache.access[_cache.index[item.url]] = time() - (3 - i) * 2 * 86400
+        _cache.save()
+
+        _input = source / "input.toml"
+        toml = '[a]\nurl = "https://example.com/a"\n'
+        toml += f'expected = "{sha256(b"a").hexdigest()}"\n'
+        _input.write_text(toml)
+        with contextlib.redirect_stdout(StringIO()):
+            main([f"--cache={cache}", "--gc", *extra, str(_input)])
+        remaining = {i.name for i in cache.joinpath("sha256").iterdir()}
+        return {i for i in "abc" if sha256(i.encode()).hexdigest() in remaining}
+
+    def test_max_size(self) -> None:
+        """Remove the least recently used download that is not referenced."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            remaining = self._gc(source, cache, ["--cache-max-size=2"])
+            self.assertEqual(remaining, {"a", "c"})
+            b = sha256(b"b").hexdigest()
+            index = json.loads(cache.joinpath("index.json").read_text())
+            self.assertNotIn(b, index.values())
+            self.assertNotIn(b, json.loads(cache.joinpath("access.json").read_text()))
+
+    def test_locks(self) -> None:
+        """Remove the locks for downloads that were evicted."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            self._gc(source, cache, ["--cache-max-size=2"])
+            locks = {i.name for i in cache.joinpath("locks").iterdir()}
+            for name, expected in (("a", True), ("b", False), ("c", True)):
+                url = source.joinpath(name).as_uri()
+                lock = f"{sha256(url.encode()).hexdigest()}.lock"
+                self.assertEqual(lock in locks, expected)
+            self.assertIn("cache", locks)
+
+    def test_max_age(self) -> None:
+        """Remove downloads that have not been used recently."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            remaining = self._gc(source, cache, ["--cache-max-age=3"])
+            self.assertEqual(remaining, {"a", "c"})
+
+    def test_no_limit(self) -> None:
+        """Remove nothing without a limit."""
+        with _directory("source_") as source, _directory("cache_") as cache:
+            remaining = self._gc(source, cache, [])
+            self.assertEqual(remaining, {"a", "b", "c"})
+
 
 if __name__ == "__main__":
     unittest.main()